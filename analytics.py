@@ -0,0 +1,162 @@
+import threading
+
+import numpy as np
+from sqlalchemy import select
+
+from earnings import AGE_BUCKETS, OLDEST_AGE_BUCKET, check_postal_prefix, normalize_gender, postal_prefix
+from models import Order, from_cents, to_cents
+
+GROUP_BY_FIELDS = ("day", "month", "postal_prefix", "gender", "age_bucket")
+
+
+class EarningsCube:
+    # Order facts kept as NumPy columns: order id, day, total in cents, postal prefix, gender and birth year.
+    # Prefixes and genders are stored as codes into small lookup lists. New orders are appended,
+    # so filters and group-bys never have to go to the database once the cube is loaded.
+    # Orders are appended in commit order, not id order, _rows maps every order id to its row.
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._size = 0
+        self._rows = {}
+        self._removed = set()
+        self._loading = False
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._days = np.zeros(capacity, dtype="datetime64[D]")
+        self._totals = np.zeros(capacity, dtype=np.int64)
+        self._prefixes = np.zeros(capacity, dtype=np.int32)
+        self._genders = np.zeros(capacity, dtype=np.int32)
+        self._birth_years = np.zeros(capacity, dtype=np.int16)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._prefix_codes = {}
+        self._gender_codes = {}
+        self.loaded = False
+
+    def load(self, session):
+        # Appends start before the query, so an order committed while loading is not missed.
+        # It may also be read by the load, _append skips ids it already has.
+        self.loaded = True
+        self._loading = True
+        orders = session.execute(
+            select(Order.Id, Order.order_date, Order.total_price, Order.customer_address,
+                   Order.customer_gender, Order.customer_birthdate)
+            .where(Order.status != "Cancelled")
+            .order_by(Order.Id)
+            .execution_options(yield_per=10000)
+        )
+        try:
+            for row in orders:
+                self._append(*row)
+        finally:
+            with self._lock:
+                self._loading = False
+                self._removed.clear()
+
+    def append_order(self, order):
+        self.append(order.Id, order.order_date, order.total_price, order.customer_address,
+                    order.customer_gender, order.customer_birthdate)
+
+    def append(self, order_id, order_date, total_price, address, gender, birthdate):
+        # Orders placed before load() are picked up by the load itself
+        if self.loaded:
+            self._append(order_id, order_date, total_price, address, gender, birthdate)
+
+    def remove_order(self, order_id):
+        with self._lock:
+            index = self._rows.get(order_id)
+            if index is not None:
+                self._valid[index] = False
+            elif self._loading:
+                # Cancelled while load() runs, the load may still read it from before the cancel
+                self._removed.add(order_id)
+
+    def earnings(self, start=None, end=None, postal_code_prefix=None, gender=None, min_age=None, max_age=None,
+                 group_by=()):
+        # start/end are dates (end exclusive), ages are taken at the order date by birth year.
+        # Without group_by the total is returned, otherwise a dict of group key tuple -> total.
+        for field in group_by:
+            if field not in GROUP_BY_FIELDS:
+                raise ValueError(f"Unknown group by field: {field}")
+        with self._lock:
+            size = self._size
+            days = self._days[:size]
+            totals = self._totals[:size]
+            prefixes = self._prefixes[:size]
+            genders = self._genders[:size]
+            mask = self._valid[:size].copy()
+            ages = days.astype("datetime64[Y]").astype(np.int64) + 1970 - self._birth_years[:size]
+            prefix_labels = list(self._prefix_codes)
+            gender_labels = list(self._gender_codes)
+
+        if start is not None:
+            mask &= days >= np.datetime64(start, "D")
+        if end is not None:
+            mask &= days < np.datetime64(end, "D")
+        if postal_code_prefix:
+            postal_code_prefix = check_postal_prefix(postal_code_prefix)
+            mask &= prefixes == (prefix_labels.index(postal_code_prefix) if postal_code_prefix in prefix_labels else -1)
+        if gender:
+            gender = normalize_gender(gender)
+            mask &= genders == (gender_labels.index(gender) if gender in gender_labels else -1)
+        if min_age is not None:
+            mask &= ages >= min_age
+        if max_age is not None:
+            mask &= ages <= max_age
+
+        if not group_by:
+            return from_cents(totals[mask].sum())
+
+        columns = []
+        labels = []
+        for field in group_by:
+            if field == "day":
+                columns.append(days[mask].astype(np.int64))
+                labels.append(lambda value: np.datetime64(value, "D").item())
+            elif field == "month":
+                columns.append(days[mask].astype("datetime64[M]").astype(np.int64))
+                labels.append(lambda value: str(np.datetime64(value, "M")))
+            elif field == "postal_prefix":
+                columns.append(prefixes[mask])
+                labels.append(prefix_labels.__getitem__)
+            elif field == "gender":
+                columns.append(genders[mask])
+                labels.append(gender_labels.__getitem__)
+            else:
+                uppers = [upper for upper, _ in AGE_BUCKETS]
+                bucket_labels = [bucket for _, bucket in AGE_BUCKETS] + [OLDEST_AGE_BUCKET]
+                columns.append(np.digitize(ages[mask], uppers))
+                labels.append(bucket_labels.__getitem__)
+
+        if not columns[0].size:
+            return {}
+        keys, inverse = np.unique(np.stack(columns, axis=1), axis=0, return_inverse=True)
+        sums = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(sums, inverse.ravel(), totals[mask])
+        return {
+            tuple(label(int(value)) for label, value in zip(labels, key)): from_cents(total)
+            for key, total in zip(keys, sums)
+        }
+
+    def _append(self, order_id, order_date, total_price, address, gender, birthdate):
+        with self._lock:
+            if order_id in self._rows or order_id in self._removed:
+                return
+            if self._size == len(self._ids):
+                self._grow()
+            index = self._size
+            self._rows[order_id] = index
+            self._ids[index] = order_id
+            self._days[index] = np.datetime64(order_date.date(), "D")
+            self._totals[index] = to_cents(total_price)
+            self._prefixes[index] = self._prefix_codes.setdefault(postal_prefix(address), len(self._prefix_codes))
+            self._genders[index] = self._gender_codes.setdefault(normalize_gender(gender), len(self._gender_codes))
+            self._birth_years[index] = birthdate.year
+            self._valid[index] = True
+            self._size += 1
+
+    def _grow(self):
+        capacity = len(self._ids) * 2
+        for name in ("_ids", "_days", "_totals", "_prefixes", "_genders", "_birth_years", "_valid"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
@@ -0,0 +1,315 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, update
+from sqlalchemy.sql import func
+
+from change_feed import order_changes
+from customer_handling import CustomerHandling
+from database import get_async_session, get_task_session
+from models import Customer, Order, normalize_username
+from order import ORDER_STATUS_MAP, StatusScheduler, get_status_scheduler
+from pizza_service import PizzaService
+from routing import RoutePlanner
+from staff_operations import StaffOp
+
+# The menu cache and the route planner load under a threading lock. A task holding that lock while it
+# waits for the database would block every other task on the loop, so only one task may load at a time.
+_menu_lock = asyncio.Lock()
+_coordinates_lock = asyncio.Lock()
+
+_schedulers = {}
+
+
+def get_async_status_scheduler(db_url):
+    # One scheduler per database for the whole process, it follows the current session factory
+    # so it keeps working after database.dispose_all_async()
+    scheduler = _schedulers.get(db_url)
+    if scheduler is None:
+        scheduler = AsyncStatusScheduler(get_async_session(db_url), ORDER_STATUS_MAP)
+        _schedulers[db_url] = scheduler
+    scheduler.session = get_async_session(db_url)
+    return scheduler
+
+
+class AsyncService:
+    # Every call gets its own AsyncSession, so calls from many tasks run concurrently on one event loop.
+    # Synchronous service code runs inside AsyncSession.run_sync on the sync side of that session,
+    # which the services reach through the task-local registry from database.get_task_session.
+    def __init__(self, db_url, session_factory=None):
+        self.session_factory = session_factory if session_factory is not None else get_async_session(db_url)
+        self.task_session = get_task_session(db_url)
+
+    async def _run_sync(self, function, *args, **kwargs):
+        async with self.session_factory() as session:
+            self.task_session.registry.set(session.sync_session)
+            try:
+                return await session.run_sync(lambda _: function(*args, **kwargs))
+            finally:
+                self.task_session.registry.clear()
+
+
+class AsyncStatusScheduler(StatusScheduler):
+    # Same heap as StatusScheduler, driven by a task on the event loop instead of a thread
+    def __init__(self, session_factory, status_map):
+        super().__init__(session_factory, status_map)
+        self._event = asyncio.Event()
+        self._task = None
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+        self._event.set()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._running = True
+            # A new event as well, the old one may belong to a loop that is gone
+            self._event = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _wake(self):
+        self._event.set()
+
+    async def _run(self):
+        while True:
+            self._event.clear()
+            with self._condition:
+                if not self._running:
+                    return
+                due = self._pop_due()
+                timeout = self._timeout()
+            if due:
+                await self._apply(due)
+                continue
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _apply(self, due):
+        try:
+            async with self.session() as session:
+                await session.execute(self._status_update(due))
+                await session.commit()
+            order_changes.publish(due.keys())
+        except Exception as e:
+            print(f"An error occurred while updating order statuses: {e}")
+
+
+class AsyncOrderStatusTracker(AsyncService):
+    def __init__(self, db_url, session_factory=None, persist_transitions=False):
+        super().__init__(db_url, session_factory)
+        self.status_map = dict(ORDER_STATUS_MAP)
+        # Without persist_transitions the kitchen stages are published by the shared thread scheduler,
+        # it never touches the database so it does not have to run on the loop
+        if persist_transitions:
+            self.scheduler = get_async_status_scheduler(db_url)
+        else:
+            self.scheduler = get_status_scheduler(db_url, persist_transitions=False)
+
+    def start_tracking(self, order_id, order_date=None):
+        # Not a coroutine, PizzaService.create_order calls it from inside run_sync
+        self.scheduler.schedule(order_id, order_date or datetime.now())
+
+    async def get_order_status(self, order_id):
+        async with self.session_factory() as session:
+            return (await session.execute(select(Order.current_status).where(Order.Id == order_id))).scalar_one()
+
+    async def confirm_delivery(self, order_id):
+        async with self.session_factory() as session:
+            result = await session.execute(
+                update(Order)
+                .where(Order.Id == order_id, Order.status == "Out for Delivery")
+                .values(status="Delivered")
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        if result.rowcount:
+            order_changes.publish([order_id])
+            return True
+        return False
+
+    async def cancel_order(self, order_id):
+        async with self.session_factory() as session:
+            order = (await session.execute(select(Order).filter_by(Id=order_id))).scalar_one()
+            elapsed_time = (datetime.now() - order.order_date).total_seconds() / 60
+            cancellation_limit = min(self.status_map.keys())
+            if elapsed_time < cancellation_limit:
+                order.status = "Cancelled"
+                await session.commit()
+                self.scheduler.discard(order_id)
+                order_changes.publish([order_id])
+                return True
+            return False
+
+    async def get_order_count(self, customer_id):
+        async with self.session_factory() as session:
+            return (await session.execute(
+                select(func.count()).select_from(Order).where(Order.customer_id == customer_id)
+            )).scalar()
+
+    async def is_birthday(self, customer_id):
+        async with self.session_factory() as session:
+            birthdate = (await session.execute(select(Customer.birthdate).where(Customer.Id == customer_id))).scalar_one()
+        today = datetime.now().date()
+        return birthdate.month == today.month and birthdate.day == today.day
+
+
+class AsyncPizzaService(AsyncService):
+    def __init__(self, db_url, session_factory=None, order_status_tracker=None, loyalty_ledger=None,
+                 birthday_index=None, earnings_rollup=None, earnings_cube=None, recommender=None):
+        super().__init__(db_url, session_factory)
+        if order_status_tracker is None:
+            order_status_tracker = AsyncOrderStatusTracker(db_url, session_factory=self.session_factory)
+        self.order_status_tracker = order_status_tracker
+        self.pizza_service = PizzaService(
+            db_url, session=self.task_session, order_status_tracker=order_status_tracker,
+            loyalty_ledger=loyalty_ledger, birthday_index=birthday_index, earnings_rollup=earnings_rollup,
+            earnings_cube=earnings_cube, recommender=recommender
+        )
+        self._customer_locks = defaultdict(asyncio.Lock)
+
+    async def fetch_pizzas(self):
+        async with _menu_lock:
+            return await self._run_sync(self.pizza_service.fetch_pizzas)
+
+    async def fetch_drinks(self):
+        async with _menu_lock:
+            return await self._run_sync(self.pizza_service.fetch_drinks)
+
+    async def fetch_desserts(self):
+        async with _menu_lock:
+            return await self._run_sync(self.pizza_service.fetch_desserts)
+
+    async def fetch_ingredients(self):
+        return await self._run_sync(self.pizza_service.fetch_ingredients)
+
+    async def add_pizza(self, name, is_vegetarian, is_vegan, price):
+        return await self._run_sync(self.pizza_service.add_pizza, name, is_vegetarian, is_vegan, price)
+
+    async def update_pizza(self, pizza_id, name=None, is_vegetarian=None, is_vegan=None, price=None):
+        return await self._run_sync(self.pizza_service.update_pizza, pizza_id, name=name,
+                                    is_vegetarian=is_vegetarian, is_vegan=is_vegan, price=price)
+
+    async def delete_pizza(self, pizza_id):
+        return await self._run_sync(self.pizza_service.delete_pizza, pizza_id)
+
+    async def calculate_pizza_price(self, pizza_id):
+        return await self._run_sync(self.pizza_service.calculate_pizza_price, pizza_id)
+
+    async def calculate_menu_prices(self, pizza_ids=None):
+        return await self._run_sync(self.pizza_service.calculate_menu_prices, pizza_ids)
+
+    async def refresh_menu_prices(self, pizza_ids=None):
+        return await self._run_sync(self.pizza_service.refresh_menu_prices, pizza_ids)
+
+    async def update_ingredient(self, ingredient_id, name=None, cost=None, is_vegetarian=None, is_vegan=None):
+        return await self._run_sync(self.pizza_service.update_ingredient, ingredient_id, name=name, cost=cost,
+                                    is_vegetarian=is_vegetarian, is_vegan=is_vegan)
+
+    async def set_pizza_ingredients(self, pizza_id, ingredient_ids):
+        return await self._run_sync(self.pizza_service.set_pizza_ingredients, pizza_id, ingredient_ids)
+
+    async def fetch_dietary_info(self, pizza_id):
+        return await self._run_sync(self.pizza_service.fetch_dietary_info, pizza_id)
+
+    async def refresh_dietary_info(self, pizza_ids=None):
+        return await self._run_sync(self.pizza_service.refresh_dietary_info, pizza_ids)
+
+    async def create_order(self, customer_id, cart, customer_phone=""):
+        # Orders of one customer update the same loyalty row, they are placed one after the other
+        async with self._customer_locks[customer_id]:
+            return await self._run_sync(self.pizza_service.create_order, customer_id, cart, customer_phone)
+
+    async def cancel_order(self, order_id):
+        if await self.order_status_tracker.cancel_order(order_id):
+            return await self._run_sync(self.pizza_service.delete_cancelled_order, order_id)
+        return False
+
+
+class AsyncStaffOp(AsyncService):
+    def __init__(self, db_url, session_factory=None):
+        super().__init__(db_url, session_factory)
+        self.staff_op = StaffOp(db_url, session=self.task_session)
+
+    async def display_pending_orders(self):
+        return await self._run_sync(self.staff_op.display_pending_orders)
+
+    async def pending_order_changes(self, cursor=None):
+        return await self._run_sync(self.staff_op.pending_order_changes, cursor)
+
+    async def confirm_delivery(self, order_id):
+        return await self._run_sync(self.staff_op.confirm_delivery, order_id)
+
+    def subscribe_to_order_changes(self, callback):
+        # Callbacks run on the writer's thread or task, use loop.call_soon_threadsafe to get back on a loop
+        self.staff_op.subscribe_to_order_changes(callback)
+
+    def unsubscribe_from_order_changes(self, callback):
+        self.staff_op.unsubscribe_from_order_changes(callback)
+
+    async def generate_monthly_earnings_report(self, postal_code_prefix=None, gender=None, age_bucket=None):
+        return await self._run_sync(self.staff_op.generate_monthly_earnings_report, postal_code_prefix=postal_code_prefix,
+                                    gender=gender, age_bucket=age_bucket)
+
+
+class AsyncCustomerHandling(AsyncService):
+    def __init__(self, db_url, session_factory=None, route_planner=None):
+        super().__init__(db_url, session_factory)
+        if route_planner is None:
+            route_planner = RoutePlanner(db_url, session=self.task_session)
+        self.route_planner = route_planner
+        self.customer_handling = CustomerHandling(db_url, session=self.task_session, route_planner=route_planner)
+
+    async def register_customer(self, name, gender, birthdate, address, password):
+        async with self.session_factory() as session:
+            existing = (await session.execute(
+                select(Customer.Id).filter_by(username=normalize_username(name))
+            )).first()
+        if existing:
+            print(f"Customer '{name}' already exists.")
+            return False
+        new_customer = Customer(
+            name=name,
+            gender=gender,
+            birthdate=birthdate,
+            address=address
+        )
+        # bcrypt takes a good part of a second, it must not run on the event loop
+        await asyncio.to_thread(new_customer.set_pw, password)
+        async with self.session_factory() as session:
+            try:
+                session.add(new_customer)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                print(f"Error registering customer: {e}")
+                return False
+        print(f"Customer '{name} registered successfully")
+        return True
+
+    async def login_customer(self, name, password):
+        async with self.session_factory() as session:
+            customer = (await session.execute(
+                select(Customer).filter_by(username=normalize_username(name))
+            )).scalars().first()
+        if customer and await asyncio.to_thread(customer.check_pw, password):
+            print(f"Customer '{name}' logged in successfully")
+            return True
+        else:
+            print("Invalid name or Password")
+            return False
+
+    async def send_order_confirmation(self, order_id, customer_email):
+        await self._load_coordinates()
+        return await self._run_sync(self.customer_handling.send_order_confirmation, order_id, customer_email)
+
+    async def calculate_estimated_delivery_time(self, order_id):
+        await self._load_coordinates()
+        return await self._run_sync(self.customer_handling.calculate_estimated_delivery_time, order_id)
+
+    async def _load_coordinates(self):
+        async with _coordinates_lock:
+            await self._run_sync(self.route_planner.load_coordinates)
@@ -0,0 +1,87 @@
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from database import get_session
+from models import Admin, Customer, normalize_username
+
+AUTH_WORKERS = 2
+TOKEN_LIFETIME = timedelta(minutes=30)
+
+
+class AuthService:
+    # Runs bcrypt checks on a small thread pool so the GUI thread never hashes. A successful login
+    # returns a short lived session token, privileged actions check the token instead of the password.
+    # The session should be a scoped session (the default), every worker thread gets its own.
+    def __init__(self, db_url, session=None, max_workers=AUTH_WORKERS, token_lifetime=TOKEN_LIFETIME):
+        self.session = session if session is not None else get_session(db_url)
+        self.token_lifetime = token_lifetime
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="auth")
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def login_customer(self, username, password, callback=None):
+        # The future resolves to ("customer", customer id, token) or False
+        return self._submit(Customer, "customer", username, password, callback)
+
+    def login_admin(self, username, password, callback=None):
+        # The future resolves to ("admin", admin id, token) or False
+        return self._submit(Admin, "admin", username, password, callback)
+
+    def validate_token(self, token, role=None):
+        # Returns the user id for a valid token, expired tokens are dropped
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            token_role, user_id, expires_at = entry
+            if expires_at <= datetime.now():
+                del self._tokens[token]
+                return None
+            if role is not None and token_role != role:
+                return None
+            return user_id
+
+    def revoke_token(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, model, role, username, password, callback):
+        future = self._executor.submit(self._login, model, role, username, password)
+        if callback is not None:
+            future.add_done_callback(lambda done: callback(done.result() if not done.exception() else False))
+        return future
+
+    def _login(self, model, role, username, password):
+        try:
+            user = self.session.query(model).filter_by(username=normalize_username(username)).first()
+            if not user or not user.check_pw(password):
+                print(f"Invalid {role} username or password")
+                return False
+            if user.needs_rehash():
+                # The work factor changed since this hash was made, upgrade it now that we know the password
+                user.set_pw(password)
+                self.session.commit()
+            print(f"{role.capitalize()} '{username}' logged in successfully")
+            return role, user.Id, self._issue_token(role, user.Id)
+        except Exception as e:
+            self.session.rollback()
+            print(f"An error occurred while logging in: {e}")
+            return False
+        finally:
+            # Worker threads are reused, do not keep their objects around between logins
+            if hasattr(self.session, "remove"):
+                self.session.remove()
+
+    def _issue_token(self, role, user_id):
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            now = datetime.now()
+            for expired in [key for key, entry in self._tokens.items() if entry[2] <= now]:
+                del self._tokens[expired]
+            self._tokens[token] = (role, user_id, now + self.token_lifetime)
+        return token
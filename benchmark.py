@@ -0,0 +1,318 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy import select
+
+from database import get_engine, get_session
+from earnings import EarningsRollup
+from menu_cache import menu_cache
+from migrations import migrate
+from models import (Customer, DeliveryPersonnel, Dessert, Drink, Ingredient, Order, Pizza, from_cents,
+                    normalize_username, order_drinks, order_pizzas, pizza_ingredients)
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+from riders import RiderManagement
+from staff_operations import StaffOp
+
+# Seeded volumes, all of them can be changed from the command line
+VOLUMES = {
+    "customers": 5000,
+    "pizzas": 20,
+    "ingredients": 30,
+    "drinks": 6,
+    "desserts": 4,
+    "riders": 100,
+    "postal_codes": 50,
+    "orders": 200000,
+    "open_orders": 500,
+    "days": 365,
+}
+SEED_CHUNK = 20000
+# The last open_orders orders were placed within the last hour and are still open,
+# all older ones were delivered or cancelled
+OPEN_ORDER_WINDOW = timedelta(hours=1)
+CANCELLED_SHARE = 0.02
+REGRESSION_THRESHOLD = 0.20
+
+
+def seed(db_url, volumes, seed_value):
+    # Builds the models.py schema and fills it with reproducible data, same seed -> same database
+    rng = random.Random(seed_value)
+    migrate(db_url)
+    engine = get_engine(db_url)
+    now = datetime.now()
+    postal_codes = [f"{6200 + index}{chr(65 + index % 26)}{chr(65 + index // 26 % 26)}"
+                    for index in range(volumes["postal_codes"])]
+    # bcrypt is far too slow to hash every seeded customer, they all share one hash
+    password = Customer(name="benchmark", gender="N/A", birthdate=now, address="")
+    password.set_pw("benchmark")
+
+    with engine.begin() as connection:
+        customers = []
+        for customer_id in range(1, volumes["customers"] + 1):
+            name = f"Customer {customer_id}"
+            customers.append({
+                "Id": customer_id,
+                "Name": name,
+                "Username": normalize_username(name),
+                "Gender": rng.choice(["Male", "Female", "Other"]),
+                "Birthdate": datetime(rng.randint(1950, 2008), rng.randint(1, 12), rng.randint(1, 28)),
+                "Address": f"{rng.choice(postal_codes)} Street {rng.randint(1, 200)}",
+                "Password": password.password,
+            })
+        _insert(connection, Customer.__table__, customers)
+
+        _insert(connection, Ingredient.__table__, [
+            {"Id": ingredient_id, "name": f"Ingredient {ingredient_id}", "Cost": from_cents(rng.randint(20, 300)),
+             "IsVegetarian": rng.random() < 0.7, "IsVegan": rng.random() < 0.4}
+            for ingredient_id in range(1, volumes["ingredients"] + 1)
+        ])
+        _insert(connection, Pizza.__table__, [
+            {"Id": pizza_id, "name": f"Pizza {pizza_id}", "IsVegetarian": False, "IsVegan": False,
+             "Price": from_cents(0)}
+            for pizza_id in range(1, volumes["pizzas"] + 1)
+        ])
+        _insert(connection, pizza_ingredients, [
+            {"PizzaId": pizza_id, "IngredientId": ingredient_id}
+            for pizza_id in range(1, volumes["pizzas"] + 1)
+            for ingredient_id in rng.sample(range(1, volumes["ingredients"] + 1), min(rng.randint(3, 6), volumes["ingredients"]))
+        ])
+        _insert(connection, Drink.__table__, [
+            {"Id": drink_id, "name": f"Drink {drink_id}", "Price": from_cents(rng.randint(150, 400))}
+            for drink_id in range(1, volumes["drinks"] + 1)
+        ])
+        _insert(connection, Dessert.__table__, [
+            {"Id": dessert_id, "name": f"Dessert {dessert_id}", "Price": from_cents(rng.randint(300, 700))}
+            for dessert_id in range(1, volumes["desserts"] + 1)
+        ])
+        _insert(connection, DeliveryPersonnel.__table__, [
+            {"Id": rider_id, "name": f"Rider {rider_id}", "postalCode": postal_codes[rider_id % len(postal_codes)],
+             "available": True}
+            for rider_id in range(1, volumes["riders"] + 1)
+        ])
+
+        history = timedelta(days=volumes["days"]) - OPEN_ORDER_WINDOW
+        first_open = volumes["orders"] - volumes["open_orders"] + 1
+        for start in range(1, volumes["orders"] + 1, SEED_CHUNK):
+            orders, pizzas, drinks = [], [], []
+            for order_id in range(start, min(start + SEED_CHUNK, volumes["orders"] + 1)):
+                customer = customers[rng.randrange(len(customers))]
+                # Oldest orders first, like a real orders table
+                if order_id >= first_open:
+                    order_date = now - OPEN_ORDER_WINDOW * ((volumes["orders"] + 1 - order_id) / (volumes["open_orders"] + 1))
+                    status, rider_id, dispatched_at = "Pending", None, None
+                else:
+                    order_date = now - OPEN_ORDER_WINDOW - history * (1 - order_id / first_open)
+                    status, rider_id, dispatched_at = "Delivered", rng.randint(1, volumes["riders"]), order_date + timedelta(minutes=25)
+                if status == "Delivered" and rng.random() < CANCELLED_SHARE:
+                    status, rider_id, dispatched_at = "Cancelled", None, None
+                orders.append({
+                    "Id": order_id,
+                    "OrderDate": order_date,
+                    "CustomerName": customer["Name"],
+                    "CustomerGender": customer["Gender"],
+                    "CustomerBirthdate": customer["Birthdate"],
+                    "CustomerPhone": "",
+                    "CustomerAddress": customer["Address"],
+                    "IsDiscountApplied": False,
+                    "TotalPrice": from_cents(rng.randint(900, 6000)),
+                    "CustomerId": customer["Id"],
+                    "Status": status,
+                    "RiderId": rider_id,
+                    "DispatchedAt": dispatched_at,
+                })
+                pizzas.extend({"OrderId": order_id, "PizzaId": pizza_id}
+                              for pizza_id in rng.sample(range(1, volumes["pizzas"] + 1), min(rng.randint(1, 3), volumes["pizzas"])))
+                if rng.random() < 0.5:
+                    drinks.append({"OrderId": order_id, "DrinkId": rng.randint(1, volumes["drinks"])})
+            _insert(connection, Order.__table__, orders)
+            _insert(connection, order_pizzas, pizzas)
+            _insert(connection, order_drinks, drinks)
+
+    session = get_session(db_url)
+    pizza_service = PizzaService(db_url, session=session)
+    pizza_service.refresh_menu_prices()
+    pizza_service.refresh_dietary_info()
+    EarningsRollup(db_url, session=session).rebuild()
+    session.remove()
+
+
+def run_benchmarks(db_url, volumes, repeat, seed_value):
+    # Each benchmark is (name, function, setup). setup() is not timed and returns the arguments.
+    rng = random.Random(seed_value)
+    session = get_session(db_url)
+    order_status_tracker = OrderStatusTracker(db_url, session=session)
+    pizza_service = PizzaService(db_url, session=session, order_status_tracker=order_status_tracker)
+    staff_op = StaffOp(db_url, session=session)
+    rider_management = RiderManagement(db_url, session=session)
+    open_orders = list(session.execute(
+        select(Order.Id).where(Order.status == "Pending", Order.rider_id.is_(None)).order_by(Order.Id)
+    ).scalars())
+    rng.shuffle(open_orders)
+    postal_prefixes = sorted({address[:3] for address in session.execute(select(Customer.address)).scalars()})
+
+    def random_customer():
+        return (rng.randint(1, volumes["customers"]),)
+
+    def random_cart():
+        cart = [{"type": "Pizza", "id": rng.randint(1, volumes["pizzas"]), "quantity": rng.randint(1, 2)},
+                {"type": "Drink", "id": rng.randint(1, volumes["drinks"]), "quantity": 1}]
+        return rng.randint(1, volumes["customers"]), cart
+
+    def cold_menu():
+        menu_cache.bump()
+        return ()
+
+    def open_order():
+        if not open_orders:
+            raise RuntimeError("Not enough open orders for the rider assignment benchmark")
+        return (session.get(Order, open_orders.pop()),)
+
+    def release_rider(order):
+        # Riders go back to the pool right away, otherwise later runs would only time "no rider available"
+        session.refresh(order)
+        if order.rider_id is not None:
+            rider_management.rider_pool.release(order.rider_id)
+            rider_management.sync()
+
+    # (name, timed function, setup returning its arguments, teardown called with the same arguments),
+    # setup and teardown run outside the timer
+    benchmarks = [
+        ("fetch_pizzas", pizza_service.fetch_pizzas, cold_menu, None),
+        ("fetch_pizzas_cached", pizza_service.fetch_pizzas, None, None),
+        ("calculate_pizza_price", pizza_service.calculate_pizza_price, lambda: (rng.randint(1, volumes["pizzas"]),),
+         None),
+        ("calculate_menu_prices", pizza_service.calculate_menu_prices, None, None),
+        ("create_order", pizza_service.create_order, random_cart, None),
+        ("get_order_count", order_status_tracker.get_order_count, random_customer, None),
+        ("display_pending_orders", staff_op.display_pending_orders, None, None),
+        ("generate_monthly_earnings_report", staff_op.generate_monthly_earnings_report,
+         lambda: (rng.choice(postal_prefixes),), None),
+        ("assign_rider_to_order", rider_management.assign_rider_to_order, open_order, release_rider),
+    ]
+
+    results = {}
+    for name, function, setup, teardown in benchmarks:
+        timings = []
+        for _ in range(repeat):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            function(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+            if teardown is not None:
+                teardown(*args)
+            # Every run starts from a clean session, like a new GUI action would
+            session.expire_all()
+        results[name] = {
+            "runs": repeat,
+            "min_ms": round(min(timings), 3),
+            "median_ms": round(statistics.median(timings), 3),
+            "mean_ms": round(statistics.fmean(timings), 3),
+            "max_ms": round(max(timings), 3),
+        }
+        print(f"{name:36} median {results[name]['median_ms']:10.3f} ms   min {results[name]['min_ms']:10.3f} ms")
+    session.remove()
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    # Median against median, returns the names that got slower by more than threshold
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            print(f"{name:36} no baseline")
+            continue
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+        verdict = "REGRESSION" if ratio > 1 + threshold else "ok"
+        print(f"{name:36} {before['median_ms']:10.3f} -> {result['median_ms']:10.3f} ms  x{ratio:5.2f}  {verdict}")
+        if verdict != "ok":
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times the hot paths on a seeded SQLite database.")
+    for name, default in VOLUMES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=default, dest=name)
+    parser.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "pizza_benchmark.db"),
+                        help="SQLite file, it is reused when it was seeded with the same volumes and seed")
+    parser.add_argument("--reseed", action="store_true", help="Seed the database again even if it can be reused")
+    parser.add_argument("--seed", type=int, default=1453)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Allowed slowdown of the median before a benchmark counts as a regression")
+    args = parser.parse_args(argv)
+
+    volumes = {name: getattr(args, name) for name in VOLUMES}
+    db_url = f"sqlite:///{os.path.abspath(args.db)}"
+    seed_file = args.db + ".json"
+    seeded_with = {"volumes": volumes, "seed": args.seed}
+    reuse = not args.reseed and os.path.exists(args.db) and os.path.exists(seed_file)
+    if reuse:
+        with open(seed_file) as file:
+            reuse = json.load(file) == seeded_with
+    if not reuse:
+        for path in (args.db, seed_file):
+            if os.path.exists(path):
+                os.remove(path)
+        print(f"Seeding {args.db} ...")
+        start = time.perf_counter()
+        seed(db_url, volumes, args.seed)
+        print(f"Seeded in {time.perf_counter() - start:.1f} s")
+        with open(seed_file, "w") as file:
+            json.dump(seeded_with, file)
+    else:
+        print(f"Reusing {args.db}")
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "volumes": volumes,
+        "results": run_benchmarks(db_url, volumes, args.repeat, args.seed),
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline.get("volumes") != volumes:
+        print("WARNING: the baseline was measured with different volumes")
+    regressions = compare(report["results"], baseline, args.threshold)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def _insert(connection, table, rows):
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import calendar
+import threading
+from datetime import date
+
+from sqlalchemy import and_, extract, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from database import get_session
+from models import BirthdayRedemption, Customer
+
+
+class BirthdayIndex:
+    # Set of customers that have their birthday today, rebuilt with one query when the date changes.
+    # Customers who already got their free pizza and drink this year are kept in a second set.
+    def __init__(self, db_url, session=None):
+        self.session = session if session is not None else get_session(db_url)
+        self._day = None
+        self._birthdays = frozenset()
+        self._redeemed = set()
+        self._lock = threading.Lock()
+
+    def is_birthday(self, customer_id):
+        self._refresh_if_needed()
+        return customer_id in self._birthdays
+
+    def can_redeem(self, customer_id):
+        self._refresh_if_needed()
+        return customer_id in self._birthdays and customer_id not in self._redeemed
+
+    def redeem(self, customer_id):
+        # Does not commit, the caller commits together with the order and then calls mark_redeemed().
+        # Another service may have redeemed since the last refresh, then the savepoint is rolled back
+        # and False is returned so the order goes through without the offer.
+        try:
+            with self.session.begin_nested():
+                self.session.add(BirthdayRedemption(customer_id=customer_id, year=self._day.year))
+        except IntegrityError:
+            self.mark_redeemed(customer_id)
+            return False
+        return True
+
+    def mark_redeemed(self, customer_id):
+        with self._lock:
+            self._redeemed.add(customer_id)
+
+    def refresh(self):
+        today = date.today()
+        days = [(today.month, today.day)]
+        if today.month == 2 and today.day == 28 and not calendar.isleap(today.year):
+            days.append((2, 29))
+        birthday_filter = or_(*[
+            and_(extract("month", Customer.birthdate) == month, extract("day", Customer.birthdate) == day)
+            for month, day in days
+        ])
+        birthdays = frozenset(self.session.execute(select(Customer.Id).where(birthday_filter)).scalars())
+        redeemed = set(self.session.execute(
+            select(BirthdayRedemption.customer_id).where(BirthdayRedemption.year == today.year)
+        ).scalars()) & birthdays
+        with self._lock:
+            self._birthdays = birthdays
+            self._redeemed = redeemed
+            self._day = today
+
+    def _refresh_if_needed(self):
+        # Rebuilt lazily on the first check after midnight
+        if self._day != date.today():
+            self.refresh()
@@ -0,0 +1,60 @@
+import threading
+from collections import deque
+
+CHANGE_LOG_SIZE = 10000
+
+
+class OrderChangeFeed:
+    # Monotonic change sequence for orders written by this process. Every write that touches
+    # orders publishes their ids, readers keep a cursor and only fetch what changed since.
+    def __init__(self, log_size=CHANGE_LOG_SIZE):
+        self.sequence = 0
+        self._log = deque(maxlen=log_size)
+        self._dropped = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def publish(self, order_ids):
+        order_ids = list(order_ids)
+        if not order_ids:
+            return self.sequence
+        with self._lock:
+            self.sequence += 1
+            sequence = self.sequence
+            for order_id in order_ids:
+                if len(self._log) == self._log.maxlen:
+                    self._dropped = self._log[0][0]
+                self._log.append((sequence, order_id))
+            subscribers = list(self._subscribers)
+        # Callbacks run on the writer's thread, GUI code has to hand them over to its own loop
+        for callback in subscribers:
+            try:
+                callback(sequence, order_ids)
+            except Exception as e:
+                print(f"An error occurred in an order change subscriber: {e}")
+        return sequence
+
+    def changes_since(self, cursor):
+        # Returns (new cursor, changed order ids), or (new cursor, None) when the cursor is too old
+        # for the log and the reader has to reload everything
+        with self._lock:
+            if cursor is None or cursor < self._dropped or cursor > self.sequence:
+                return self.sequence, None
+            changed = set()
+            for sequence, order_id in reversed(self._log):
+                if sequence <= cursor:
+                    break
+                changed.add(order_id)
+            return self.sequence, changed
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+
+order_changes = OrderChangeFeed()
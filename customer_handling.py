@@ -1,17 +1,24 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from datetime import datetime
 
-from models import Customer, Order
+from database import get_session
+from models import Customer, Order, normalize_username
+from routing import RoutePlanner
+
+# What customers are told when no estimate can be made
+DEFAULT_DELIVERY_ESTIMATE = "30 minutes"
 
 # This class handles all
 class CustomerHandling:
-    def __init__(self, db_url):
-        engine = create_engine(db_url)
-        session = sessionmaker(bind=engine)
-        self.session = session()
+    def __init__(self, db_url, session=None, route_planner=None):
+        self.session = session if session is not None else get_session(db_url)
+        self.route_planner = route_planner if route_planner is not None else RoutePlanner(db_url, session=self.session)
 
 
     def register_customer(self, name, gender, birthdate, address, password):
+        # Usernames are unique, "Bob " and "bob" are the same login
+        if self.session.query(Customer).filter_by(username=normalize_username(name)).first():
+            print(f"Customer '{name}' already exists.")
+            return False
         new_customer = Customer(
             name = name,
             gender=gender,
@@ -19,12 +26,19 @@ class CustomerHandling:
             address=address
         )
         new_customer.set_pw(password)
-        self.session.add(new_customer)
-        self.session.commit()
+        try:
+            self.session.add(new_customer)
+            self.session.commit()
+        except Exception as e:
+            # Also covers a concurrent registration of the same name, the shared session must stay usable
+            self.session.rollback()
+            print(f"Error registering customer: {e}")
+            return False
         print(f"Customer '{name} registered successfully")
+        return True
 
     def login_customer(self,name, password):
-        customer = self.session.query(Customer).filter_by(name=name).first()
+        customer = self.session.query(Customer).filter_by(username=normalize_username(name)).first()
         if customer and customer.check_pw(password):
             print(f"Customer '{name}' logged in successfully")
             return True
@@ -44,7 +58,14 @@ class CustomerHandling:
             print(f"An error occurred: {e}")
 
     def calculate_estimated_delivery_time(self, order_id):
-        return "30 minutes"
+        try:
+            now = datetime.now()
+            delivery_time = self.route_planner.estimated_delivery(order_id, now)
+            minutes = max(0, round((delivery_time - now).total_seconds() / 60))
+            return f"{minutes} minutes"
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return DEFAULT_DELIVERY_ESTIMATE
 
     def send_email(self, customer_email, param, order_details):
         pass
\ No newline at end of file
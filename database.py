@@ -0,0 +1,125 @@
+import asyncio
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+# One engine (and therefore one connection pool) per database url for the whole process.
+# Services should never call create_engine themselves, they get their session from here.
+POOL_SETTINGS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
+
+# Async drivers used for the same database by the asyncio services
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+}
+
+_engines = {}
+_sessions = {}
+_async_engines = {}
+_async_sessions = {}
+_task_sessions = {}
+_lock = threading.Lock()
+
+
+def configure_pool(**settings):
+    # Only affects engines created after the call
+    for key in settings:
+        if key not in POOL_SETTINGS:
+            raise ValueError(f"Unknown pool setting: {key}")
+    POOL_SETTINGS.update(settings)
+
+
+def get_engine(db_url):
+    with _lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            engine = create_engine(db_url, **_engine_options(db_url))
+            _engines[db_url] = engine
+        return engine
+
+
+def get_session(db_url):
+    # Returns the thread-local session registry, it can be used like a normal Session
+    engine = get_engine(db_url)
+    with _lock:
+        registry = _sessions.get(db_url)
+        if registry is None:
+            registry = scoped_session(sessionmaker(bind=engine))
+            _sessions[db_url] = registry
+        return registry
+
+
+def get_async_engine(db_url):
+    # db_url is the normal (sync) url, the driver is swapped for its asyncio counterpart
+    with _lock:
+        engine = _async_engines.get(db_url)
+        if engine is None:
+            engine = create_async_engine(async_url(db_url), **_engine_options(db_url))
+            _async_engines[db_url] = engine
+        return engine
+
+
+def get_async_session(db_url):
+    # Returns an async_sessionmaker, every unit of work opens its own AsyncSession from it
+    engine = get_async_engine(db_url)
+    with _lock:
+        factory = _async_sessions.get(db_url)
+        if factory is None:
+            factory = async_sessionmaker(engine, expire_on_commit=False)
+            _async_sessions[db_url] = factory
+        return factory
+
+
+def get_task_session(db_url):
+    # Sync session registry keyed by the running asyncio task. The async services put the sync side of
+    # their AsyncSession in it before AsyncSession.run_sync, so the synchronous services run unchanged.
+    with _lock:
+        registry = _task_sessions.get(db_url)
+        if registry is None:
+            registry = scoped_session(_no_task_session, scopefunc=asyncio.current_task)
+            _task_sessions[db_url] = registry
+        return registry
+
+
+def async_url(db_url):
+    url = make_url(db_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def dispose_all():
+    with _lock:
+        for registry in _sessions.values():
+            registry.remove()
+        for engine in _engines.values():
+            engine.dispose()
+        _sessions.clear()
+        _engines.clear()
+
+
+async def dispose_all_async():
+    with _lock:
+        engines = list(_async_engines.values())
+        _async_engines.clear()
+        _async_sessions.clear()
+        _task_sessions.clear()
+    for engine in engines:
+        await engine.dispose()
+
+
+def _no_task_session():
+    raise RuntimeError("No async unit of work is running in this task")
+
+
+def _engine_options(db_url):
+    if make_url(db_url).get_backend_name() == "sqlite":
+        # SQLite picks its own pool class, only pre-ping makes sense there
+        return {"pool_pre_ping": POOL_SETTINGS["pool_pre_ping"]}
+    return dict(POOL_SETTINGS)
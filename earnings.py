@@ -0,0 +1,116 @@
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import delete, inspect, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.sql import func
+
+from database import get_session
+from models import DailyEarnings, Order
+
+AGE_BUCKETS = [(18, "<18"), (25, "18-24"), (35, "25-34"), (45, "35-44"), (55, "45-54"), (65, "55-64")]
+OLDEST_AGE_BUCKET = "65+"
+POSTAL_PREFIX_LENGTH = 3
+
+# Dialects with an INSERT ... ON CONFLICT / ON DUPLICATE KEY statement for the rollup rows
+UPSERT_DIALECTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert, "mysql": mysql.insert}
+
+
+def postal_prefix(address):
+    # Addresses start with the postal code, the reports filter on its first three characters
+    return (address or "").strip()[:POSTAL_PREFIX_LENGTH]
+
+
+def check_postal_prefix(prefix):
+    # Only the first three characters are kept, a longer prefix would silently match more than asked
+    prefix = (prefix or "").strip()
+    if len(prefix) != POSTAL_PREFIX_LENGTH:
+        raise ValueError(f"Postal code prefix must be {POSTAL_PREFIX_LENGTH} characters, got '{prefix}'")
+    return prefix
+
+
+def normalize_gender(gender):
+    return (gender or "").strip().lower()[:32]
+
+
+def age_bucket(birthdate, on_date):
+    age = on_date.year - birthdate.year - ((on_date.month, on_date.day) < (birthdate.month, birthdate.day))
+    for upper, bucket in AGE_BUCKETS:
+        if age < upper:
+            return bucket
+    return OLDEST_AGE_BUCKET
+
+
+class EarningsRollup:
+    # Daily earnings per (day, postal prefix, gender, age bucket). Orders are added when they are
+    # placed and removed when they are cancelled, in the caller's transaction.
+    def __init__(self, db_url, session=None):
+        self.session = session if session is not None else get_session(db_url)
+
+    def add_order(self, order):
+        self._apply(order, 1)
+
+    def remove_order(self, order):
+        self._apply(order, -1)
+
+    def monthly_earnings(self, year, month, postal_code_prefix=None, gender=None, age_bucket=None):
+        start = date(year, month, 1)
+        end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+        query = select(func.sum(DailyEarnings.earnings)).where(DailyEarnings.day >= start, DailyEarnings.day < end)
+        if postal_code_prefix:
+            query = query.where(DailyEarnings.postal_prefix == check_postal_prefix(postal_code_prefix))
+        if gender:
+            query = query.where(DailyEarnings.gender == normalize_gender(gender))
+        if age_bucket:
+            query = query.where(DailyEarnings.age_bucket == age_bucket)
+        return self.session.execute(query).scalar() or Decimal('0.00')
+
+    def rebuild(self):
+        # Recomputes the whole rollup from the orders table, only needed once for existing data
+        totals = {}
+        orders = self.session.execute(
+            select(Order.order_date, Order.customer_address, Order.customer_gender, Order.customer_birthdate, Order.total_price)
+            .where(Order.status != "Cancelled")
+            .execution_options(yield_per=1000)
+        )
+        for order_date, address, gender, birthdate, total_price in orders:
+            key = (order_date.date(), postal_prefix(address), normalize_gender(gender), age_bucket(birthdate, order_date))
+            count, earnings = totals.get(key, (0, Decimal('0.00')))
+            totals[key] = (count + 1, earnings + total_price)
+        self.session.execute(delete(DailyEarnings))
+        self.session.add_all([
+            DailyEarnings(day=day, postal_prefix=prefix, gender=gender, age_bucket=bucket, order_count=count, earnings=earnings)
+            for (day, prefix, gender, bucket), (count, earnings) in totals.items()
+        ])
+        self.session.commit()
+
+    def _apply(self, order, sign):
+        key = dict(
+            day=order.order_date.date(),
+            postal_prefix=postal_prefix(order.customer_address),
+            gender=normalize_gender(order.customer_gender),
+            age_bucket=age_bucket(order.customer_birthdate, order.order_date)
+        )
+        upsert = UPSERT_DIALECTS.get(self.session.get_bind().dialect.name)
+        if upsert is not None:
+            # One statement, concurrent orders for a row that does not exist yet cannot both insert it
+            columns = inspect(DailyEarnings).columns
+            values = {columns[name]: value for name, value in key.items()}
+            values.update({columns.order_count: sign, columns.earnings: sign * order.total_price})
+            insert = upsert(DailyEarnings.__table__).values(values)
+            new = insert.inserted if isinstance(insert, mysql.Insert) else insert.excluded
+            totals = {column: column + new[column.name] for column in (columns.order_count, columns.earnings)}
+            if isinstance(insert, mysql.Insert):
+                insert = insert.on_duplicate_key_update(totals)
+            else:
+                insert = insert.on_conflict_do_update(index_elements=list(DailyEarnings.__table__.primary_key),
+                                                      set_=totals)
+            self.session.execute(insert)
+            return
+        row = self.session.execute(select(DailyEarnings).filter_by(**key).with_for_update()).scalar_one_or_none()
+        if row is None:
+            row = DailyEarnings(order_count=0, earnings=Decimal('0.00'), **key)
+            self.session.add(row)
+        row.order_count += sign
+        row.earnings += sign * order.total_price
+        self.session.flush()
@@ -0,0 +1,93 @@
+import threading
+from decimal import Decimal
+
+from sqlalchemy import select
+from sqlalchemy.sql import func
+
+from database import get_session
+from models import LoyaltyAccount, Order, order_pizzas
+
+PIZZAS_FOR_DISCOUNT = 10
+LOYALTY_DISCOUNT = Decimal('0.1')
+
+
+def count_pizzas(state, pizza_count):
+    # The counting rule for one order, (pizza count, discount earned) -> (discount, new state).
+    # New orders and the replay of a customer's history both go through here, so they always agree.
+    count, earned = state
+    discount = LOYALTY_DISCOUNT if earned else Decimal('0')
+    count += pizza_count
+    earned = count >= PIZZAS_FOR_DISCOUNT
+    if earned:
+        count -= PIZZAS_FOR_DISCOUNT
+    return discount, (count, earned)
+
+
+class LoyaltyLedger:
+    # Per customer pizza counter. The row is updated in the same transaction as the order (or its
+    # cancellation), the in-memory cache only answers read-only checks like has_discount.
+    # Pizzas are counted by quantity, two of the same pizza count as two.
+    def __init__(self, db_url, session=None):
+        self.session = session if session is not None else get_session(db_url)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def has_discount(self, customer_id):
+        state = self._cache.get(customer_id)
+        if state is None:
+            account = self.session.get(LoyaltyAccount, customer_id)
+            state = (account.pizza_count, account.discount_earned) if account else self._history(customer_id)
+            self.remember(customer_id, state)
+        return state[1]
+
+    def record_order(self, customer_id, pizza_count):
+        # Does not commit, the caller commits together with the order and then calls remember()
+        account = self.session.execute(
+            select(LoyaltyAccount).where(LoyaltyAccount.customer_id == customer_id).with_for_update()
+        ).scalar_one_or_none()
+        if account is None:
+            count, earned = self._history(customer_id)
+            account = LoyaltyAccount(customer_id=customer_id, pizza_count=count, discount_earned=earned)
+            self.session.add(account)
+
+        discount, (account.pizza_count, account.discount_earned) = count_pizzas(
+            (account.pizza_count, account.discount_earned), pizza_count
+        )
+        self.session.flush()
+        return discount, (account.pizza_count, account.discount_earned)
+
+    def recount(self, customer_id):
+        # Called after a cancelled order was deleted (and flushed): the row is replayed from the orders
+        # that are left, which also gives back a discount the cancelled order used. Does not commit,
+        # returns the new state for remember(), None when the customer has no row yet.
+        account = self.session.execute(
+            select(LoyaltyAccount).where(LoyaltyAccount.customer_id == customer_id).with_for_update()
+        ).scalar_one_or_none()
+        if account is None:
+            return None
+        account.pizza_count, account.discount_earned = self._history(customer_id)
+        self.session.flush()
+        return account.pizza_count, account.discount_earned
+
+    def remember(self, customer_id, state):
+        with self._lock:
+            self._cache[customer_id] = state
+
+    def forget(self, customer_id):
+        with self._lock:
+            self._cache.pop(customer_id, None)
+
+    def _history(self, customer_id):
+        # Replays the customer's orders oldest first, used when the row does not exist yet and by recount()
+        orders = self.session.execute(
+            select(func.coalesce(func.sum(order_pizzas.c.Quantity), 0))
+            .select_from(Order)
+            .outerjoin(order_pizzas, order_pizzas.c.OrderId == Order.Id)
+            .where(Order.customer_id == customer_id, Order.status != "Cancelled")
+            .group_by(Order.Id, Order.order_date)
+            .order_by(Order.order_date, Order.Id)
+        ).scalars()
+        state = (0, False)
+        for pizza_count in orders:
+            _, state = count_pizzas(state, pizza_count)
+        return state
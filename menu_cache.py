@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from models import Pizza, Drink, Dessert
+
+# Immutable menu records handed out to the GUI and services instead of ORM objects
+PizzaRecord = namedtuple('PizzaRecord', ['Id', 'name', 'price', 'is_vegetarian', 'is_vegan'])
+ItemRecord = namedtuple('ItemRecord', ['Id', 'name', 'price'])
+
+MENU_CACHE_TTL = 300
+
+
+class MenuCache:
+    # Process wide snapshot of the menu. Writers in this process call bump() after committing,
+    # the ttl covers changes made by other processes (set it to None to disable).
+    def __init__(self, ttl=MENU_CACHE_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self._snapshot = None
+        self._snapshot_version = -1
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+
+    def get(self, session, item_type):
+        snapshot = self._snapshot
+        if not self._is_fresh():
+            snapshot = self._reload(session)
+        return snapshot.get(item_type, ())
+
+    def _is_fresh(self):
+        if self._snapshot is None or self._snapshot_version != self.version:
+            return False
+        return self.ttl is None or time.monotonic() - self._loaded_at < self.ttl
+
+    def _reload(self, session):
+        # The queries run without the lock, under AsyncSession.run_sync they give the event loop back and a
+        # writer on the loop thread would block in bump() on a lock held across that await
+        version = self.version
+        snapshot = {
+            "Pizza": tuple(PizzaRecord._make(row) for row in session.execute(
+                select(Pizza.Id, Pizza.name, Pizza.price, Pizza.is_vegetarian, Pizza.is_vegan).order_by(Pizza.Id))),
+            "Drink": tuple(ItemRecord._make(row) for row in session.execute(
+                select(Drink.Id, Drink.name, Drink.price).order_by(Drink.Id))),
+            "Dessert": tuple(ItemRecord._make(row) for row in session.execute(
+                select(Dessert.Id, Dessert.name, Dessert.price).order_by(Dessert.Id))),
+        }
+        with self._lock:
+            # A reload that started later may have finished first, the older snapshot must not replace it.
+            # A bump during the queries leaves the snapshot stale, the next get() loads it again.
+            if version >= self._snapshot_version:
+                self._snapshot = snapshot
+                self._snapshot_version = version
+                self._loaded_at = time.monotonic()
+        return snapshot
+
+menu_cache = MenuCache()
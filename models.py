@@ -1,37 +1,106 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Table
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import create_engine, BigInteger, Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, Index, Table, TypeDecorator, case
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import relationship, sessionmaker, validates
 import bcrypt
 
 Base = declarative_base()
 
+# bcrypt work factor for new hashes, older hashes are upgraded on the next successful login
+BCRYPT_ROUNDS = 12
+
 pizza_ingredients = Table('pizzaingredients', Base.metadata,
     Column('PizzaId', Integer, ForeignKey('pizzas.Id'), primary_key=True),
     Column('IngredientId', Integer, ForeignKey('ingredients.Id'), primary_key=True)
 )
 
+# One row per distinct item of an order, Quantity says how many of it were ordered
 order_pizzas = Table('orderpizzas', Base.metadata,
     Column('OrderId', Integer, ForeignKey('orders.Id'), primary_key=True),
-    Column('PizzaId', Integer, ForeignKey('pizzas.Id'), primary_key=True)
+    Column('PizzaId', Integer, ForeignKey('pizzas.Id'), primary_key=True),
+    Column('Quantity', Integer, nullable=False, default=1)
 )
 
 order_drinks = Table('orderdrinks', Base.metadata,
     Column('OrderId', Integer, ForeignKey('orders.Id'), primary_key=True),
-    Column('DrinkId', Integer, ForeignKey('drinks.Id'), primary_key=True)
+    Column('DrinkId', Integer, ForeignKey('drinks.Id'), primary_key=True),
+    Column('Quantity', Integer, nullable=False, default=1)
 )
 
 order_desserts = Table('orderdesserts', Base.metadata,
     Column('OrderId', Integer, ForeignKey('orders.Id'), primary_key=True),
-    Column('DessertId', Integer, ForeignKey('desserts.Id'), primary_key=True)
+    Column('DessertId', Integer, ForeignKey('desserts.Id'), primary_key=True),
+    Column('Quantity', Integer, nullable=False, default=1)
 )
 
+def password_rounds(password_hash):
+    # bcrypt hashes look like $2b$12$..., the second field is the work factor
+    try:
+        return int(password_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+CENT = Decimal('0.01')
+
+def to_cents(amount):
+    amount = Decimal(str(amount))
+    if not amount.is_finite():
+        raise ValueError(f"Money amounts must be finite, got {amount}")
+    return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_cents(cents):
+    return (Decimal(int(cents)) / 100).quantize(CENT)
+
+class Money(TypeDecorator):
+    # Stored as whole cents in a BIGINT, Python code always sees a Decimal with two places
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_cents(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_cents(value)
+
+# Kitchen stages are not written to the database, they follow from the minutes since the order date and
+# are worked out when the status is read. Order.status only changes on real events: rider dispatch
+# ("Out for Delivery"), delivery confirmation ("Delivered") and cancellation.
+KITCHEN_STAGES = {5: "Preparing", 20: "Prepared"}
+DERIVED_STATUSES = ("Pending",) + tuple(KITCHEN_STAGES.values())
+
+def derive_order_status(status, order_date, now=None):
+    if status not in DERIVED_STATUSES:
+        return status
+    elapsed = (now or datetime.now()) - order_date
+    for minutes, stage in sorted(KITCHEN_STAGES.items(), reverse=True):
+        if elapsed >= timedelta(minutes=minutes):
+            return stage
+    return status
+
+def order_status_case(status, order_date, now=None):
+    # SQL version of derive_order_status, the cutoffs are computed here so any database can compare them
+    now = now or datetime.now()
+    return case(
+        (status.notin_(DERIVED_STATUSES), status),
+        *[(order_date <= now - timedelta(minutes=minutes), stage)
+          for minutes, stage in sorted(KITCHEN_STAGES.items(), reverse=True)],
+        else_=status
+    )
+
+def normalize_username(name):
+    # Logins and duplicate checks go through this, so "Bob " and "bob" are the same user
+    return (name or "").strip().casefold()
+
 class Pizza(Base):
     __tablename__ = 'pizzas'
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
     is_vegetarian = Column(Boolean, name='IsVegetarian', nullable=False)
     is_vegan = Column(Boolean, name='IsVegan', nullable=False)
-    price = Column(Float, name='Price', nullable=False)
+    price = Column(Money, name='Price', nullable=False)
 
     ingredients = relationship('Ingredient', secondary=pizza_ingredients, back_populates='pizzas')
     orders = relationship('Order', secondary=order_pizzas, back_populates='pizzas')
@@ -40,7 +109,7 @@ class Ingredient(Base):
     __tablename__ = 'ingredients'
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    cost = Column(Float, name='Cost', nullable=False)
+    cost = Column(Money, name='Cost', nullable=False)
     is_vegetarian = Column(Boolean, name='IsVegetarian', nullable=False)
     is_vegan = Column(Boolean, name='IsVegan', nullable=False)
 
@@ -50,7 +119,7 @@ class Drink(Base):
     __tablename__ = 'drinks'
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    price = Column(Float, name='Price', nullable=False)
+    price = Column(Money, name='Price', nullable=False)
 
     orders = relationship('Order', secondary=order_drinks, back_populates='drinks')
 
@@ -58,7 +127,7 @@ class Dessert(Base):
     __tablename__ = 'desserts'
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    price = Column(Float, name='Price', nullable=False)
+    price = Column(Money, name='Price', nullable=False)
 
     orders = relationship('Order', secondary=order_desserts, back_populates='desserts')
 
@@ -66,6 +135,7 @@ class Customer(Base):
     __tablename__ = 'customers'
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, name='Name', nullable=False)
+    username = Column(String(255), name='Username', unique=True, index=True)
     gender = Column(String, name='Gender', nullable=False)
     birthdate = Column(DateTime, name='Birthdate', nullable=False)
     address = Column(String, name='Address', nullable=False)
@@ -74,33 +144,86 @@ class Customer(Base):
     orders = relationship('Order', back_populates='customer')
 
     def set_pw(self, password):
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
     def check_pw(self, password):
         return bcrypt.checkpw(password.encode('utf-8'), self.password.encode('utf-8'))
 
+    def needs_rehash(self):
+        return password_rounds(self.password) != BCRYPT_ROUNDS
+
+    @validates('name')
+    def _set_username(self, key, name):
+        self.username = normalize_username(name)
+        return name
+
+class LoyaltyAccount(Base):
+    __tablename__ = 'customer_loyalty'
+    customer_id = Column(Integer, ForeignKey('customers.Id'), name='CustomerId', primary_key=True)
+    pizza_count = Column(Integer, name='PizzaCount', nullable=False, default=0)
+    discount_earned = Column(Boolean, name='DiscountEarned', nullable=False, default=False)
+
+class BirthdayRedemption(Base):
+    __tablename__ = 'birthday_redemptions'
+    customer_id = Column(Integer, ForeignKey('customers.Id'), name='CustomerId', primary_key=True)
+    year = Column(Integer, name='Year', primary_key=True)
+
+class DailyEarnings(Base):
+    __tablename__ = 'earnings_rollup'
+    day = Column(Date, name='Day', primary_key=True)
+    postal_prefix = Column(String(3), name='PostalPrefix', primary_key=True)
+    gender = Column(String(32), name='Gender', primary_key=True)
+    age_bucket = Column(String(8), name='AgeBucket', primary_key=True)
+    order_count = Column(Integer, name='OrderCount', nullable=False, default=0)
+    earnings = Column(Money, name='Earnings', nullable=False, default=0)
+
 class DeliveryPersonnel(Base):
     __tablename__ = 'delivery_personnel'
+    __table_args__ = (
+        Index('ix_delivery_personnel_postalCode_available', 'postalCode', 'available', mysql_length={'postalCode': 16}),
+    )
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
     postalCode = Column(String, nullable=False)
     available = Column(Boolean, nullable=False)
 
+class PostalCodeLocation(Base):
+    __tablename__ = 'postal_codes'
+    postal_code = Column(String(10), name='PostalCode', primary_key=True)
+    latitude = Column(Float, name='Latitude', nullable=False)
+    longitude = Column(Float, name='Longitude', nullable=False)
+
 class Admin(Base):
     __tablename__ = 'admins'
     Id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, name='Name', nullable=False)
+    username = Column(String(255), name='Username', unique=True, index=True)
     gender = Column(String, name='Gender', nullable=False)
     password = Column(String, name='Password', nullable=False)
 
     def set_pw(self, password):
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
     def check_pw(self, password):
         return bcrypt.checkpw(password.encode('utf-8'), self.password.encode('utf-8'))
 
+    def needs_rehash(self):
+        return password_rounds(self.password) != BCRYPT_ROUNDS
+
+    @validates('name')
+    def _set_username(self, key, name):
+        self.username = normalize_username(name)
+        return name
+
 class Order(Base):
     __tablename__ = 'orders'
+    # Longtext columns can only be indexed with a prefix length on MySQL
+    __table_args__ = (
+        Index('ix_orders_CustomerId', 'CustomerId'),
+        Index('ix_orders_Status_OrderDate', 'Status', 'OrderDate', mysql_length={'Status': 32}),
+        Index('ix_orders_OrderDate', 'OrderDate'),
+        Index('ix_orders_RiderId_DispatchedAt', 'RiderId', 'DispatchedAt'),
+    )
     Id = Column(Integer, primary_key=True, autoincrement=True)
     order_date = Column(DateTime, name='OrderDate', nullable=False)
     customer_name = Column(String, name='CustomerName', nullable=False)
@@ -109,11 +232,22 @@ class Order(Base):
     customer_phone = Column(String, name='CustomerPhone', nullable=False)
     customer_address = Column(String, name='CustomerAddress', nullable=False)
     is_discount_applied = Column(Boolean, name='IsDiscountApplied', nullable=False)
-    total_price = Column(Float, name='TotalPrice', nullable=False)
+    total_price = Column(Money, name='TotalPrice', nullable=False)
     customer_id = Column(Integer, ForeignKey('customers.Id'), name='CustomerId', nullable=True)
     status = Column(String, name='Status', default='Pending', nullable=False)
+    rider_id = Column(Integer, ForeignKey('delivery_personnel.Id'), name='RiderId', nullable=True)
+    dispatched_at = Column(DateTime, name='DispatchedAt', nullable=True)
+
+    @hybrid_property
+    def current_status(self):
+        return derive_order_status(self.status, self.order_date)
+
+    @current_status.expression
+    def current_status(cls):
+        return order_status_case(cls.status, cls.order_date)
 
     customer = relationship('Customer', back_populates='orders')
+    rider = relationship('DeliveryPersonnel')
     pizzas = relationship('Pizza', secondary=order_pizzas, back_populates='orders')
     drinks = relationship('Drink', secondary=order_drinks, back_populates='orders')
     desserts = relationship('Dessert', secondary=order_desserts, back_populates='orders')
@@ -1,41 +1,196 @@
+import heapq
+import itertools
 import threading
-import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import case, select, update
 
-from models import Order, Customer
+from change_feed import order_changes
+from database import get_session
+from models import DERIVED_STATUSES, KITCHEN_STAGES, Order, Customer
 
+# Minutes after the order date -> status the order moves to, only written by the StatusScheduler
+# when a tracker is created with persist_transitions=True
+ORDER_STATUS_MAP = {5: "Preparing", 20: "Prepared", 30: "Out for Delivery", 40: "Delivered"}
 
-class OrderStatusTracker:
-	def __init__(self, db_url):
-		engine = create_engine(db_url)
-		Session = sessionmaker(bind=engine)
-		self.session = Session()
-		self.status_map = {5: "Preparing", 20: "Prepared", 30: "Out for Delivery", 40: "Delivered"}
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_status_scheduler(db_url, persist_transitions=True):
+	# One scheduler thread per database for the whole process, like the engines in database.py.
+	# Without persist_transitions it only publishes the derived kitchen stages to the change feed.
+	with _schedulers_lock:
+		scheduler = _schedulers.get((db_url, persist_transitions))
+		if scheduler is None:
+			if persist_transitions:
+				scheduler = StatusScheduler(get_session(db_url), ORDER_STATUS_MAP)
+			else:
+				scheduler = StatusScheduler(None, KITCHEN_STAGES, persist=False)
+			_schedulers[(db_url, persist_transitions)] = scheduler
+		return scheduler
+
+
+class StatusScheduler:
+	# One thread for all tracked orders. The heap holds (deadline, order_id, transition index) for the
+	# next transition of every order, and all transitions that are due are written in one UPDATE.
+	# _entries maps every tracked order to the token of its live heap entry, discarded or rescheduled
+	# orders leave entries with an old token behind that are dropped when they are popped.
+	# With persist=False nothing is written, the due orders are only published to the change feed.
+	def __init__(self, session, status_map, persist=True):
+		self.session = session
+		self.persist = persist
+		self._transitions = sorted(status_map.items())
+		self._heap = []
+		self._entries = {}
+		self._tokens = itertools.count()
+		self._condition = threading.Condition()
+		self._thread = None
+		self._running = False
+
+	def schedule(self, order_id, order_date):
+		now = datetime.now()
+		index = 0
+		while index < len(self._transitions) and self._deadline(order_date, index) <= now:
+			index += 1
+		with self._condition:
+			token = next(self._tokens)
+			if index > 0:
+				# The order is older than some transitions, catch up with the latest one right away
+				heapq.heappush(self._heap, (now, order_id, index - 1, order_date, token))
+			elif self._transitions:
+				heapq.heappush(self._heap, (self._deadline(order_date, 0), order_id, 0, order_date, token))
+			else:
+				return
+			self._entries[order_id] = token
+			self._ensure_running()
+			self._wake()
+
+	def discard(self, order_id):
+		with self._condition:
+			self._entries.pop(order_id, None)
+
+	def stop(self):
+		with self._condition:
+			self._running = False
+			self._condition.notify()
+
+	def _deadline(self, order_date, index):
+		return order_date + timedelta(minutes=self._transitions[index][0])
 
-	def start_tracking(self, order_id):
-		threading.Thread(target=self._update_status, args=(order_id), daemon=True).start()
+	def _ensure_running(self):
+		if self._thread is None or not self._thread.is_alive():
+			self._running = True
+			self._thread = threading.Thread(target=self._run, daemon=True)
+			self._thread.start()
 
-	def _update_status(self, order_id):
+	def _wake(self):
+		self._condition.notify()
+
+	def _run(self):
 		while True:
-			time.sleep(60)
-			order = self.session.query(Order).filter_by(Id=order_id).one()
-			elapsed_time = (datetime.now() - order.order_date).total_seconds() / 60
-			for time_limit, status in self.status_map.items():
-				if elapsed_time < time_limit:
-					order.status = status
-					self.session.commit()
-					break
+			with self._condition:
+				while self._running and (not self._heap or self._heap[0][0] > datetime.now()):
+					self._condition.wait(self._timeout())
+				if not self._running:
+					return
+				due = self._pop_due()
+			if due:
+				self._apply(due)
+
+	def _timeout(self):
+		# Seconds until the next transition, None when nothing is scheduled
+		if not self._heap:
+			return None
+		return max(0.0, (self._heap[0][0] - datetime.now()).total_seconds())
+
+	def _pop_due(self):
+		# Called with the condition held, returns {order id: new status} for everything that is due
+		now = datetime.now()
+		due = {}
+		while self._heap and self._heap[0][0] <= now:
+			_, order_id, index, order_date, token = heapq.heappop(self._heap)
+			if self._entries.get(order_id) != token:
+				continue
+			# If several transitions of one order are due, the last one popped wins
+			due[order_id] = self._transitions[index][1]
+			if index + 1 < len(self._transitions):
+				heapq.heappush(self._heap, (self._deadline(order_date, index + 1), order_id, index + 1, order_date, token))
 			else:
-				order.status = "Delivered"
-				self.session.commit()
-				break
+				del self._entries[order_id]
+		return due
+
+	def _status_update(self, due):
+		return (
+			update(Order)
+			.where(Order.Id.in_(due.keys()), Order.status != "Cancelled")
+			.values(status=case(due, value=Order.Id))
+			.execution_options(synchronize_session=False)
+		)
+
+	def _apply(self, due):
+		if not self.persist:
+			order_changes.publish(due.keys())
+			return
+		try:
+			self.session.execute(self._status_update(due))
+			self.session.commit()
+			order_changes.publish(due.keys())
+		except Exception as e:
+			self.session.rollback()
+			print(f"An error occurred while updating order statuses: {e}")
+
+
+class OrderStatusTracker:
+	# By default statuses are derived when they are read (Order.current_status), the process wide scheduler
+	# only publishes the kitchen stages to the change feed when they are reached.
+	# persist_transitions=True uses the scheduler that writes every transition of ORDER_STATUS_MAP instead.
+	def __init__(self, db_url, session=None, persist_transitions=False):
+		self.session = session if session is not None else get_session(db_url)
+		self.status_map = dict(ORDER_STATUS_MAP)
+		self.scheduler = get_status_scheduler(db_url, persist_transitions)
+
+	def start_tracking(self, order_id, order_date=None):
+		self.scheduler.schedule(order_id, order_date or datetime.now())
+
+	def resume_tracking(self):
+		# Tracks the open orders placed before this process started, meant to be called once at startup
+		try:
+			since = datetime.now() - timedelta(minutes=self.scheduler._transitions[-1][0])
+			open_orders = self.session.execute(
+				select(Order.Id, Order.order_date)
+				.where(Order.status.in_(DERIVED_STATUSES), Order.order_date >= since)
+			).all()
+			self.session.commit()
+		except Exception as e:
+			self.session.rollback()
+			print(f"An error occurred while resuming order tracking: {e}")
+			return 0
+		for order_id, order_date in open_orders:
+			self.scheduler.schedule(order_id, order_date)
+		return len(open_orders)
 
 	def get_order_status(self, order_id):
-		order = self.session.query(Order).filter_by(id=order_id).one()
-		return order.status
+		return self.session.execute(select(Order.current_status).where(Order.Id == order_id)).scalar_one()
+
+	def confirm_delivery(self, order_id):
+		# Only orders a rider went out with can be confirmed
+		try:
+			result = self.session.execute(
+				update(Order)
+				.where(Order.Id == order_id, Order.status == "Out for Delivery")
+				.values(status="Delivered")
+				.execution_options(synchronize_session=False)
+			)
+			self.session.commit()
+		except Exception as e:
+			self.session.rollback()
+			print(f"An error occurred while confirming delivery: {e}")
+			return False
+		if result.rowcount:
+			order_changes.publish([order_id])
+			return True
+		return False
 
 	def cancel_order(self, order_id):
 		order = self.session.query(Order).filter_by(Id=order_id).one()
@@ -44,6 +199,8 @@ class OrderStatusTracker:
 		if elapsed_time < cancellation_limit:
 			order.status = "Cancelled"
 			self.session.commit()
+			self.scheduler.discard(order_id)
+			order_changes.publish([order_id])
 			return True
 		return False
 
@@ -51,6 +208,6 @@ class OrderStatusTracker:
 		return self.session.query(Order).filter_by(customer_id=customer_id).count()
 
 	def is_birthday(self, customer_id):
-		customer = self.session.query(Customer).filter_by(customer_id=customer_id).one
+		customer = self.session.query(Customer).filter_by(Id=customer_id).one()
 		today = datetime.now().date()
 		return customer.birthdate.month == today.month and customer.birthdate.day == today.day
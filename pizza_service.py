@@ -1,21 +1,53 @@
 from datetime import datetime
+from decimal import Decimal
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import Pizza, Ingredient, Drink, Dessert, Order, order_pizzas, order_drinks
+from sqlalchemy import Integer, bindparam, cast, select, update
+from sqlalchemy.sql import func
+
+from database import get_session
+from birthday import BirthdayIndex
+from change_feed import order_changes
+from earnings import EarningsRollup
+from loyalty import LoyaltyLedger
+from menu_cache import menu_cache
+from models import CENT, Pizza, Ingredient, Drink, Dessert, Order, Customer, order_pizzas, order_drinks, order_desserts, pizza_ingredients
 from order import OrderStatusTracker
 
+PROFIT_MARGIN = Decimal('0.40')
+VAT = Decimal('0.09')
+
+# item type -> (model, association table, item column in that table)
+ORDER_ITEM_TABLES = {
+    "Pizza": (Pizza, order_pizzas, "PizzaId"),
+    "Drink": (Drink, order_drinks, "DrinkId"),
+    "Dessert": (Dessert, order_desserts, "DessertId"),
+}
+
 
 class PizzaService:
-    def __init__(self, db_url):
-        engine = create_engine(db_url)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
-        self.order_status_tracker = OrderStatusTracker(db_url)
+    def __init__(self, db_url, session=None, order_status_tracker=None, loyalty_ledger=None, birthday_index=None,
+                 earnings_rollup=None, earnings_cube=None, recommender=None):
+        self.session = session if session is not None else get_session(db_url)
+        if order_status_tracker is None:
+            order_status_tracker = OrderStatusTracker(db_url, session=self.session)
+        if loyalty_ledger is None:
+            loyalty_ledger = LoyaltyLedger(db_url, session=self.session)
+        if birthday_index is None:
+            birthday_index = BirthdayIndex(db_url, session=self.session)
+        if earnings_rollup is None:
+            earnings_rollup = EarningsRollup(db_url, session=self.session)
+        self.order_status_tracker = order_status_tracker
+        self.loyalty_ledger = loyalty_ledger
+        self.birthday_index = birthday_index
+        self.earnings_rollup = earnings_rollup
+        # Optional analytics.EarningsCube that is kept up to date with new and cancelled orders
+        self.earnings_cube = earnings_cube
+        # Optional Recommender whose purchase index is updated with every new order
+        self.recommender = recommender
 
     def fetch_pizzas(self):
         try:
-            pizzas = self.session.query(Pizza).all()
+            pizzas = menu_cache.get(self.session, "Pizza")
             print("Querying worked")
             return pizzas
         except Exception as e:
@@ -31,6 +63,7 @@ class PizzaService:
         )
         self.session.add(new_pizza)
         self.session.commit()
+        menu_cache.bump()
         print(f"Pizza '{name}' added successfully!")
 
     def update_pizza(self, pizza_id, name=None, is_vegetarian=None, is_vegan=None, price=None):
@@ -45,6 +78,7 @@ class PizzaService:
             if price is not None:
                 pizza.price = price
             self.session.commit()
+            menu_cache.bump()
             print(f"Pizza '{pizza_id}' updated successfully!")
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -54,6 +88,7 @@ class PizzaService:
             pizza = self.session.query(Pizza).filter_by(Id=pizza_id).one()
             self.session.delete(pizza)
             self.session.commit()
+            menu_cache.bump()
             print(f"Pizza '{pizza_id}' deleted successfully!")
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -68,7 +103,7 @@ class PizzaService:
 
     def fetch_drinks(self):
         try:
-            drinks = self.session.query(Drink).all()
+            drinks = menu_cache.get(self.session, "Drink")
             return drinks
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -76,7 +111,7 @@ class PizzaService:
 
     def fetch_desserts(self):
         try:
-            desserts = self.session.query(Dessert).all()
+            desserts = menu_cache.get(self.session, "Dessert")
             return desserts
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -84,57 +119,268 @@ class PizzaService:
 
     def calculate_pizza_price(self, pizza_id):
         try:
-            pizza = self.session.query(Pizza).filter_by(Id=pizza_id).one()
-            ingredient_cost = sum(ingredient.price for ingredient in pizza.ingredients)
-            profit_margin = 0.40
-            vat = 0.09
-            price = ingredient_cost * (1 + profit_margin) * (1 + vat)
-            return price
+            return self.calculate_menu_prices([pizza_id]).get(pizza_id, Decimal('0.00'))
         except Exception as e:
             print(f"An error occurred: {e}")
             return None
 
+    def calculate_menu_prices(self, pizza_ids=None):
+        # One grouped query over pizzaingredients/ingredients for the whole menu (or the given pizzas)
+        query = (
+            select(pizza_ingredients.c.PizzaId, func.sum(Ingredient.cost))
+            .join(Ingredient, Ingredient.Id == pizza_ingredients.c.IngredientId)
+            .group_by(pizza_ingredients.c.PizzaId)
+        )
+        if pizza_ids is not None:
+            query = query.where(pizza_ingredients.c.PizzaId.in_(pizza_ids))
+        return {
+            pizza_id: (ingredient_cost * (1 + PROFIT_MARGIN) * (1 + VAT)).quantize(CENT)
+            for pizza_id, ingredient_cost in self.session.execute(query)
+        }
+
+    def refresh_menu_prices(self, pizza_ids=None):
+        # Writes the calculated prices into pizzas.Price, pizzas without ingredients keep their price
+        try:
+            prices = self._write_menu_prices(pizza_ids)
+            self.session.commit()
+            menu_cache.bump()
+            return prices
+        except Exception as e:
+            self.session.rollback()
+            print(f"An error occurred: {e}")
+            return {}
+
+    def update_ingredient(self, ingredient_id, name=None, cost=None, is_vegetarian=None, is_vegan=None):
+        try:
+            ingredient = self.session.query(Ingredient).filter_by(Id=ingredient_id).one()
+            if name is not None:
+                ingredient.name = name
+            if cost is not None:
+                ingredient.cost = cost
+            if is_vegetarian is not None:
+                ingredient.is_vegetarian = is_vegetarian
+            if is_vegan is not None:
+                ingredient.is_vegan = is_vegan
+            # Only the pizzas using this ingredient are recomputed, in the same transaction
+            if cost is not None or is_vegetarian is not None or is_vegan is not None:
+                self.session.flush()
+                affected = self._pizzas_using_ingredient(ingredient_id)
+                if cost is not None:
+                    self._write_menu_prices(affected)
+                if is_vegetarian is not None or is_vegan is not None:
+                    self._write_dietary_info(affected)
+            self.session.commit()
+            menu_cache.bump()
+            print(f"Ingredient '{ingredient_id}' updated successfully!")
+        except Exception as e:
+            self.session.rollback()
+            print(f"An error occurred: {e}")
+
+    def set_pizza_ingredients(self, pizza_id, ingredient_ids):
+        try:
+            self.session.execute(pizza_ingredients.delete().where(pizza_ingredients.c.PizzaId == pizza_id))
+            if ingredient_ids:
+                self.session.execute(
+                    pizza_ingredients.insert(),
+                    [{"PizzaId": pizza_id, "IngredientId": ingredient_id} for ingredient_id in ingredient_ids]
+                )
+            self._write_menu_prices([pizza_id])
+            self._write_dietary_info([pizza_id])
+            self.session.commit()
+            menu_cache.bump()
+            print(f"Ingredients of pizza '{pizza_id}' updated successfully!")
+        except Exception as e:
+            self.session.rollback()
+            print(f"An error occurred: {e}")
+
+    def _write_menu_prices(self, pizza_ids=None):
+        if pizza_ids is not None and not pizza_ids:
+            return {}
+        prices = self.calculate_menu_prices(pizza_ids)
+        if prices:
+            self.session.connection().execute(
+                update(Pizza).where(Pizza.Id == bindparam("pizza_id")).values(price=bindparam("new_price")),
+                [{"pizza_id": pizza_id, "new_price": price} for pizza_id, price in prices.items()]
+            )
+        return prices
+
+    def _pizzas_using_ingredient(self, ingredient_id):
+        return list(self.session.execute(
+            select(pizza_ingredients.c.PizzaId).where(pizza_ingredients.c.IngredientId == ingredient_id)
+        ).scalars())
+
     def fetch_dietary_info(self, pizza_id):
         try:
-            pizza = self.session.query(Pizza).filter_by(Id=pizza_id).one()
-            is_vegetarian = all(ingredient.is_vegetarian for ingredient in pizza.ingredients)
-            is_vegan = all(ingredient.is_vegan for ingredient in pizza.ingredients)
-            return {'is_vegetarian': is_vegetarian, 'is_vegan': is_vegan}
+            return self.calculate_dietary_info([pizza_id]).get(pizza_id, {'is_vegetarian': True, 'is_vegan': True})
         except Exception as e:
             print(f"An error occurred: {e}")
             return None
 
-    def create_order(self, customer_id, pizzas, drinks, desserts, is_discount_applied, total_price):
+    def calculate_dietary_info(self, pizza_ids=None):
+        # A pizza is vegetarian/vegan only if every ingredient is, so MIN over the flags does the job
+        query = (
+            select(
+                pizza_ingredients.c.PizzaId,
+                func.min(cast(Ingredient.is_vegetarian, Integer)),
+                func.min(cast(Ingredient.is_vegan, Integer))
+            )
+            .join(Ingredient, Ingredient.Id == pizza_ingredients.c.IngredientId)
+            .group_by(pizza_ingredients.c.PizzaId)
+        )
+        if pizza_ids is not None:
+            query = query.where(pizza_ingredients.c.PizzaId.in_(pizza_ids))
+        return {
+            pizza_id: {'is_vegetarian': bool(is_vegetarian), 'is_vegan': bool(is_vegan)}
+            for pizza_id, is_vegetarian, is_vegan in self.session.execute(query)
+        }
+
+    def refresh_dietary_info(self, pizza_ids=None):
+        try:
+            dietary_info = self._write_dietary_info(pizza_ids)
+            self.session.commit()
+            menu_cache.bump()
+            return dietary_info
+        except Exception as e:
+            self.session.rollback()
+            print(f"An error occurred: {e}")
+            return {}
+
+    def _write_dietary_info(self, pizza_ids=None):
+        if pizza_ids is not None and not pizza_ids:
+            return {}
+        dietary_info = self.calculate_dietary_info(pizza_ids)
+        if dietary_info:
+            self.session.connection().execute(
+                update(Pizza).where(Pizza.Id == bindparam("pizza_id")).values(
+                    is_vegetarian=bindparam("new_is_vegetarian"),
+                    is_vegan=bindparam("new_is_vegan")
+                ),
+                [
+                    {"pizza_id": pizza_id, "new_is_vegetarian": info['is_vegetarian'], "new_is_vegan": info['is_vegan']}
+                    for pizza_id, info in dietary_info.items()
+                ]
+            )
+        return dietary_info
+
+    def create_order(self, customer_id, cart, customer_phone=""):
+        # cart is a list of {'type': 'Pizza'|'Drink'|'Dessert', 'id': ..., 'quantity': ...} like the GUI cart.
+        # Every item type is resolved with one IN query and the line items are written with executemany.
         try:
-            order_count = self.order_status_tracker.get_order_count(customer_id)
-            discount = 0.1 if order_count % 10 == 0 or self.order_status_tracker.is_birthday else 0.0
-            new_order = Order (
+            quantities = {item_type: {} for item_type in ORDER_ITEM_TABLES}
+            for cart_item in cart:
+                if cart_item['type'] not in quantities:
+                    print(f"Invalid item type: {cart_item['type']}")
+                    return None
+                per_type = quantities[cart_item['type']]
+                per_type[cart_item['id']] = per_type.get(cart_item['id'], 0) + cart_item.get('quantity', 1)
+            if not quantities["Pizza"]:
+                print("An order must include at least one pizza.")
+                return None
+
+            customer = self.session.query(Customer).filter_by(Id=customer_id).one()
+            total_price = Decimal('0.00')
+            item_prices = {}
+            for item_type, per_type in quantities.items():
+                if not per_type:
+                    continue
+                model = ORDER_ITEM_TABLES[item_type][0]
+                prices = dict(self.session.execute(select(model.Id, model.price).where(model.Id.in_(per_type.keys()))).all())
+                missing = set(per_type) - set(prices)
+                if missing:
+                    print(f"{item_type} with ID {sorted(missing)} does not exist.")
+                    return None
+                item_prices[item_type] = list(prices.values())
+                total_price += sum(prices[item_id] * quantity for item_id, quantity in per_type.items())
+
+            discount, loyalty_state = self.loyalty_ledger.record_order(customer_id, sum(quantities["Pizza"].values()))
+
+            # Birthday offer: the cheapest pizza and drink of the order are free, once a year.
+            # Redeemed after the ledger write so the savepoint is taken inside the order's transaction.
+            birthday_offer = self.birthday_index.can_redeem(customer_id) and self.birthday_index.redeem(customer_id)
+            if birthday_offer:
+                total_price -= min(item_prices["Pizza"]) + min(item_prices.get("Drink", [Decimal('0.00')]))
+            new_order = Order(
                 order_date=datetime.now(),
+                customer_name=customer.name,
+                customer_gender=customer.gender,
+                customer_birthdate=customer.birthdate,
+                customer_phone=customer_phone,
+                customer_address=customer.address,
                 customer_id=customer_id,
-                is_discount_applied=is_discount_applied,
-                total_price=total_price * (1-discount),
-                status = "Pending"
+                is_discount_applied=discount > 0 or birthday_offer,
+                total_price=(total_price * (1 - discount)).quantize(CENT),
+                status="Pending"
             )
             self.session.add(new_order)
-            self.session.commit()
+            self.session.flush()
+            self.earnings_rollup.add_order(new_order)
 
-            for pizza in pizzas:
-                self.session.execute(order_pizzas.insert().values(order_id = new_order.id, pizza_id = pizza.Id))
-            for drink in drinks:
-                self.session.execute(order_drinks.insert().values(order_id = new_order.id, drink_id = drink.Id))
+            for item_type, per_type in quantities.items():
+                if not per_type:
+                    continue
+                table, column = ORDER_ITEM_TABLES[item_type][1:]
+                self.session.execute(
+                    table.insert(),
+                    [{"OrderId": new_order.Id, column: item_id, "Quantity": quantity} for item_id, quantity in per_type.items()]
+                )
+            # Everything the caller needs is read before the commit expires the order,
+            # so placing an order never costs an extra SELECT
+            confirmation = {
+                'order_id': new_order.Id,
+                'order_date': new_order.order_date,
+                'total_price': new_order.total_price,
+                'is_discount_applied': new_order.is_discount_applied,
+                'items': {item_type: dict(per_type) for item_type, per_type in quantities.items()},
+                'status': new_order.status
+            }
+            order_facts = (new_order.Id, new_order.order_date, new_order.total_price, new_order.customer_address,
+                           new_order.customer_gender, new_order.customer_birthdate)
+            self.session.commit()
+            self.loyalty_ledger.remember(customer_id, loyalty_state)
+            if birthday_offer:
+                self.birthday_index.mark_redeemed(customer_id)
+            if self.earnings_cube is not None:
+                self.earnings_cube.append(*order_facts)
+            if self.recommender is not None:
+                self.recommender.record_order(customer_id, quantities["Pizza"].keys())
+            order_changes.publish([confirmation['order_id']])
+            self.order_status_tracker.start_tracking(confirmation['order_id'], confirmation['order_date'])
+            return confirmation
         except Exception as e:
+            self.session.rollback()
+            self.loyalty_ledger.forget(customer_id)
             print(f"An error occurred: {e}")
             return None
 
     def cancel_order(self, order_id):
         if self.order_status_tracker.cancel_order(order_id):
-            try:
-                order = self.session.query(Order).filter_by(Id = order_id).one()
-                self.session.delete(order)
-                self.session.commit()
-                return True
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                return False
+            return self.delete_cancelled_order(order_id)
         else:
             return False
+
+    def delete_cancelled_order(self, order_id):
+        customer_id = None
+        try:
+            order = self.session.query(Order).filter_by(Id = order_id).one()
+            customer_id = order.customer_id
+            self.earnings_rollup.remove_order(order)
+            self.session.delete(order)
+            self.session.flush()
+            # The pizzas of the cancelled order no longer count towards the loyalty discount
+            loyalty_state = self.loyalty_ledger.recount(customer_id) if customer_id is not None else None
+            self.session.commit()
+            if loyalty_state is not None:
+                self.loyalty_ledger.remember(customer_id, loyalty_state)
+            else:
+                self.loyalty_ledger.forget(customer_id)
+            if self.earnings_cube is not None:
+                self.earnings_cube.remove_order(order_id)
+            if self.recommender is not None and customer_id is not None:
+                self.recommender.refresh_customer(customer_id)
+            order_changes.publish([order_id])
+            return True
+        except Exception as e:
+            self.session.rollback()
+            self.loyalty_ledger.forget(customer_id)
+            print(f"An error occurred: {e}")
+            return False
@@ -1,21 +1,199 @@
-from sqlalchemy.orm import sessionmaker
-from  sqlalchemy import create_engine
-from models import Pizza, Ingredient, pizza_ingredients
+import threading
+
+from sqlalchemy import select
+
+from database import get_session
+from menu_cache import menu_cache
+from models import Pizza, Ingredient, Order, order_pizzas, pizza_ingredients
 import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.preprocessing import MultiLabelBinarizer
 
+TOP_K = 5
+
+
 class Recommender:
-    def __init__(self, db_url):
-        engine = create_engine(db_url)
-        engine = sessionmaker(bind=engine)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+    def __init__(self, db_url, session=None, top_k=TOP_K):
+        self.session = session if session is not None else get_session(db_url)
+        self.top_k = top_k
+        self.pizza_ids = np.array([], dtype=np.int64)
+        self.neighbours = np.empty((0, 0), dtype=np.int64)
+        self.scores = np.empty((0, 0), dtype=np.float64)
+        self._positions = {}
+        self._menu_version = None
+
+        # Purchase based recommendations: pizza x pizza co-occurrence over customers
+        self.purchase_pizza_ids = []
+        self.cooccurrence = np.zeros((0, 0), dtype=np.int64)
+        self._purchase_positions = {}
+        self._customer_pizzas = {}
+        self._customer_recommendations = {}
+        self._purchase_lock = threading.Lock()
 
     def fetch_pizzas_with_ingredient(self):
         try:
-            pizzas = self.session.query(Pizza).all()
-            for pizza in pizzas:
-                ingredients =
+            rows = self.session.execute(
+                select(Pizza.Id, Ingredient.name)
+                .outerjoin(pizza_ingredients, pizza_ingredients.c.PizzaId == Pizza.Id)
+                .outerjoin(Ingredient, Ingredient.Id == pizza_ingredients.c.IngredientId)
+                .order_by(Pizza.Id)
+            )
+            pizzas = {}
+            for pizza_id, ingredient in rows:
+                ingredients = pizzas.setdefault(pizza_id, [])
+                if ingredient is not None:
+                    ingredients.append(ingredient)
+            return pizzas
 
         except Exception as e:
-            print(f"Something went wrong {e}")
\ No newline at end of file
+            print(f"Something went wrong {e}")
+            return {}
+
+    def build_index(self):
+        # Binary pizza x ingredient matrix -> cosine similarities -> top k neighbours per pizza
+        version = menu_cache.version
+        pizzas = self.fetch_pizzas_with_ingredient()
+        pizza_ids = np.array(list(pizzas), dtype=np.int64)
+        if len(pizza_ids) < 2:
+            neighbours = np.empty((len(pizza_ids), 0), dtype=np.int64)
+            scores = np.empty((len(pizza_ids), 0), dtype=np.float64)
+        else:
+            matrix = MultiLabelBinarizer().fit_transform(pizzas.values()).astype(np.float64)
+            norms = np.linalg.norm(matrix, axis=1)
+            norms[norms == 0] = 1.0
+            normalized = matrix / norms[:, None]
+            similarities = normalized @ normalized.T
+            np.fill_diagonal(similarities, -np.inf)
+
+            k = min(self.top_k, len(pizza_ids) - 1)
+            candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind="stable")
+            neighbours = pizza_ids[np.take_along_axis(candidates, order, axis=1)]
+            scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+        self.pizza_ids = pizza_ids
+        self.neighbours = neighbours
+        self.scores = scores
+        self._positions = {int(pizza_id): position for position, pizza_id in enumerate(pizza_ids)}
+        self._menu_version = version
+
+    def similar_pizzas(self, pizza_id, k=None):
+        # Rebuilds only when the menu changed since the last build
+        if self._menu_version != menu_cache.version:
+            self.build_index()
+        position = self._positions.get(pizza_id)
+        if position is None:
+            return []
+        # Pizzas without a single shared ingredient are not similar
+        return self.neighbours[position, :k][self.scores[position, :k] > 0].tolist()
+
+    def build_purchase_index(self):
+        # Binary customer x pizza matrix from orders/orderpizzas, co-occurrence = X^T X
+        rows = self.session.execute(
+            select(Order.customer_id, order_pizzas.c.PizzaId)
+            .join(order_pizzas, order_pizzas.c.OrderId == Order.Id)
+            .where(Order.customer_id.isnot(None), Order.status != "Cancelled")
+            .distinct()
+        ).all()
+        pizza_ids = sorted(set(self.session.execute(select(Pizza.Id)).scalars()) | {pizza_id for _, pizza_id in rows})
+        pizza_positions = {pizza_id: position for position, pizza_id in enumerate(pizza_ids)}
+        customer_ids = sorted({customer_id for customer_id, _ in rows})
+        customer_positions = {customer_id: position for position, customer_id in enumerate(customer_ids)}
+
+        purchases = csr_matrix(
+            (
+                np.ones(len(rows), dtype=np.int64),
+                ([customer_positions[customer_id] for customer_id, _ in rows],
+                 [pizza_positions[pizza_id] for _, pizza_id in rows])
+            ),
+            shape=(len(customer_ids), len(pizza_ids))
+        )
+        cooccurrence = (purchases.T @ purchases).toarray()
+
+        with self._purchase_lock:
+            self.purchase_pizza_ids = pizza_ids
+            self.cooccurrence = cooccurrence
+            self._purchase_positions = pizza_positions
+            self._customer_pizzas = {
+                customer_id: set(purchases.indices[purchases.indptr[row]:purchases.indptr[row + 1]].tolist())
+                for row, customer_id in enumerate(customer_ids)
+            }
+            self._customer_recommendations = {}
+
+    def record_order(self, customer_id, pizza_ids):
+        # Only pizzas the customer never bought before change the co-occurrence counts
+        with self._purchase_lock:
+            positions = [self._purchase_position(pizza_id) for pizza_id in set(pizza_ids)]
+            owned = self._customer_pizzas.setdefault(customer_id, set())
+            new = [position for position in positions if position not in owned]
+            if not new:
+                return
+            owned.update(new)
+            owned_list = list(owned)
+            for position in new:
+                self.cooccurrence[position, owned_list] += 1
+                self.cooccurrence[owned_list, position] += 1
+            # Pairs of two new pizzas were counted twice above
+            for position in new:
+                self.cooccurrence[position, new] -= 1
+            # Rows of every pizza the customer owns changed, so did the scores of everyone who owns one of them
+            stale = [cached for cached in self._customer_recommendations
+                     if not owned.isdisjoint(self._customer_pizzas.get(cached, ()))]
+            for cached in stale:
+                del self._customer_recommendations[cached]
+
+    def refresh_customer(self, customer_id):
+        # Recomputes one customer's purchases from the orders that are left, called after a cancellation
+        # so the incremental counts stay equal to a build_purchase_index without the cancelled order
+        pizza_ids = self.session.execute(
+            select(order_pizzas.c.PizzaId)
+            .join(Order, order_pizzas.c.OrderId == Order.Id)
+            .where(Order.customer_id == customer_id, Order.status != "Cancelled")
+            .distinct()
+        ).scalars().all()
+        with self._purchase_lock:
+            owned = {self._purchase_position(pizza_id) for pizza_id in pizza_ids}
+            previous = self._customer_pizzas.get(customer_id, set())
+            if owned == previous:
+                return
+            # The customer's contribution to X^T X is the outer product of its purchases
+            previous_list = list(previous)
+            owned_list = list(owned)
+            self.cooccurrence[np.ix_(previous_list, previous_list)] -= 1
+            self.cooccurrence[np.ix_(owned_list, owned_list)] += 1
+            if owned:
+                self._customer_pizzas[customer_id] = owned
+            else:
+                self._customer_pizzas.pop(customer_id, None)
+            changed = owned | previous
+            stale = [cached for cached in self._customer_recommendations
+                     if cached == customer_id or not changed.isdisjoint(self._customer_pizzas.get(cached, ()))]
+            for cached in stale:
+                del self._customer_recommendations[cached]
+
+    def recommend_for_customer(self, customer_id, k=None):
+        k = k or self.top_k
+        recommendations = self._customer_recommendations.get(customer_id)
+        if recommendations is None:
+            with self._purchase_lock:
+                owned = list(self._customer_pizzas.get(customer_id, ()))
+                if not owned:
+                    return []
+                scores = self.cooccurrence[owned].sum(axis=0).astype(np.float64)
+                scores[owned] = 0
+                ranked = np.argsort(-scores, kind="stable")
+                ranked = ranked[scores[ranked] > 0][:max(k, self.top_k)]
+                recommendations = [self.purchase_pizza_ids[position] for position in ranked]
+                self._customer_recommendations[customer_id] = recommendations
+        return recommendations[:k]
+
+    def _purchase_position(self, pizza_id):
+        position = self._purchase_positions.get(pizza_id)
+        if position is None:
+            # A pizza added after the build, grow the co-occurrence matrix by one row and column
+            position = len(self.purchase_pizza_ids)
+            self.purchase_pizza_ids.append(pizza_id)
+            self._purchase_positions[pizza_id] = position
+            self.cooccurrence = np.pad(self.cooccurrence, ((0, 1), (0, 1)))
+        return position
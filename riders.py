@@ -1,49 +1,328 @@
 import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError
+import heapq
+import itertools
+import re
+import threading
+from collections import deque, namedtuple
 
-from models import Rider, Order
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.sql import func
+
+from change_feed import order_changes
+from database import get_session
+from models import KITCHEN_STAGES, DeliveryPersonnel, Order, order_pizzas
+
+RIDER_COOLDOWN = datetime.timedelta(minutes=30)
+BATCH_WINDOW = datetime.timedelta(minutes=3)
+MAX_BATCH_PIZZAS = 3
+# Every order is prepared this long after it was placed, see models.KITCHEN_STAGES
+PREPARED_AFTER = datetime.timedelta(minutes=next(minutes for minutes, stage in KITCHEN_STAGES.items() if stage == "Prepared"))
+# Seconds between two runs of RiderManagement.process_orders on the dispatch thread
+DISPATCH_INTERVAL = 15
+
+# Dutch postal codes, four digits and two letters with an optional space in between
+POSTAL_CODE_PATTERN = re.compile(r"(\d{4})\s?([A-Za-z]{2})\b")
+
+DeliveryBatch = namedtuple('DeliveryBatch', ['postal_code', 'order_ids', 'pizza_count', 'opened_at'])
+
+
+def normalize_postal_code(postal_code):
+    return (postal_code or "").replace(" ", "").upper()
+
+
+def address_postal_code(address):
+    # Addresses start with the postal code, same assumption as the earnings reports.
+    # "6211 AB Markt 1" and "6211AB Markt 1" both give 6211AB, anything else falls back to the first word.
+    address = (address or "").strip()
+    match = POSTAL_CODE_PATTERN.match(address)
+    if match:
+        return normalize_postal_code(match.group(1) + match.group(2))
+    parts = address.split()
+    return normalize_postal_code(parts[0]) if parts else ""
+
+
+class RiderPool:
+    # Available riders per postal code, plus a min-heap of (available again at, rider id, postal code)
+    # for riders that are out on a delivery. Availability changes are collected and written in one batch.
+    def __init__(self, session):
+        self.session = session
+        self._available = {}
+        self._cooldowns = []
+        self._pending_writes = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        last_dispatch = dict(self.session.execute(
+            select(Order.rider_id, func.max(Order.dispatched_at))
+            .where(Order.rider_id.isnot(None))
+            .group_by(Order.rider_id)
+        ).all())
+        riders = self.session.execute(
+            select(DeliveryPersonnel.Id, DeliveryPersonnel.postalCode, DeliveryPersonnel.available)
+        ).all()
+        with self._lock:
+            self._available.clear()
+            self._cooldowns.clear()
+            for rider_id, postal_code, available in riders:
+                postal_code = normalize_postal_code(postal_code)
+                if available or last_dispatch.get(rider_id) is None:
+                    self._available.setdefault(postal_code, deque()).append(rider_id)
+                    if not available:
+                        self._pending_writes[rider_id] = True
+                else:
+                    heapq.heappush(self._cooldowns, (last_dispatch[rider_id] + RIDER_COOLDOWN, rider_id, postal_code))
+
+    def acquire(self, postal_code, now=None):
+        now = now or datetime.datetime.now()
+        postal_code = normalize_postal_code(postal_code)
+        with self._lock:
+            self._release_due(now)
+            riders = self._available.get(postal_code)
+            if not riders:
+                return None
+            rider_id = riders.popleft()
+            heapq.heappush(self._cooldowns, (now + RIDER_COOLDOWN, rider_id, postal_code))
+            self._pending_writes[rider_id] = False
+            return rider_id
+
+    def release(self, rider_id):
+        # Returns a rider before the cooldown is over
+        with self._lock:
+            for index, (_, cooling_rider, postal_code) in enumerate(self._cooldowns):
+                if cooling_rider == rider_id:
+                    self._cooldowns[index] = self._cooldowns[-1]
+                    self._cooldowns.pop()
+                    heapq.heapify(self._cooldowns)
+                    self._available.setdefault(postal_code, deque()).append(rider_id)
+                    self._pending_writes[rider_id] = True
+                    return True
+        return False
+
+    def available_count(self, postal_code):
+        with self._lock:
+            self._release_due(datetime.datetime.now())
+            return len(self._available.get(normalize_postal_code(postal_code), ()))
+
+    def flush(self, now=None):
+        # Writes the collected availability changes with one executemany, the caller commits
+        with self._lock:
+            self._release_due(now or datetime.datetime.now())
+            writes, self._pending_writes = self._pending_writes, {}
+        if writes:
+            self.session.connection().execute(
+                update(DeliveryPersonnel)
+                .where(DeliveryPersonnel.Id == bindparam("rider_id"))
+                .values(available=bindparam("is_available")),
+                [{"rider_id": rider_id, "is_available": available} for rider_id, available in writes.items()]
+            )
+        return writes
+
+    def restore(self, writes):
+        # Puts writes back after a rollback so they are retried with the next flush
+        with self._lock:
+            for rider_id, available in writes.items():
+                self._pending_writes.setdefault(rider_id, available)
+
+    def _release_due(self, now):
+        while self._cooldowns and self._cooldowns[0][0] <= now:
+            _, rider_id, postal_code = heapq.heappop(self._cooldowns)
+            self._available.setdefault(postal_code, deque()).append(rider_id)
+            self._pending_writes[rider_id] = True
+
+
+class DeliveryBatcher:
+    # Groups prepared orders per postal code. The first order opens a window of BATCH_WINDOW, the batch
+    # is closed when the window expires or when the next order would go over MAX_BATCH_PIZZAS.
+    # Windows run from the time the orders were ready (the now passed to add), not from when they were
+    # added. Closed batches are returned by add/close_expired/close_all and handed to on_batch(batch) if set.
+    def __init__(self, on_batch=None, window=BATCH_WINDOW, max_pizzas=MAX_BATCH_PIZZAS):
+        self.on_batch = on_batch
+        self.window = window
+        self.max_pizzas = max_pizzas
+        self._open = {}
+        self._deadlines = []
+        self._batch_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, order_id, postal_code, pizza_count, now=None):
+        now = now or datetime.datetime.now()
+        postal_code = normalize_postal_code(postal_code)
+        closed = []
+        with self._lock:
+            batch = self._open.get(postal_code)
+            if batch is not None and (batch['pizza_count'] + pizza_count > self.max_pizzas
+                                      or now >= batch['opened_at'] + self.window):
+                closed.append(self._close(postal_code))
+                batch = None
+            if batch is None:
+                batch = {'id': next(self._batch_ids), 'order_ids': [], 'pizza_count': 0, 'opened_at': now}
+                self._open[postal_code] = batch
+                heapq.heappush(self._deadlines, (now + self.window, batch['id'], postal_code))
+            batch['order_ids'].append(order_id)
+            batch['pizza_count'] += pizza_count
+            if batch['pizza_count'] >= self.max_pizzas:
+                closed.append(self._close(postal_code))
+        return self._hand_over(closed)
+
+    def close_expired(self, now=None):
+        now = now or datetime.datetime.now()
+        closed = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, batch_id, postal_code = heapq.heappop(self._deadlines)
+                batch = self._open.get(postal_code)
+                # Batches that were already closed by the pizza cap leave a stale heap entry
+                if batch is not None and batch['id'] == batch_id:
+                    closed.append(self._close(postal_code))
+        return self._hand_over(closed)
+
+    def close_all(self):
+        # Sends everything that is waiting, for when staff dispatch by hand
+        with self._lock:
+            closed = [self._close(postal_code) for postal_code in list(self._open)]
+            self._deadlines.clear()
+        return self._hand_over(closed)
+
+    def open_batches(self):
+        with self._lock:
+            return len(self._open)
+
+    def _close(self, postal_code):
+        batch = self._open.pop(postal_code)
+        return DeliveryBatch(postal_code, tuple(batch['order_ids']), batch['pizza_count'], batch['opened_at'])
+
+    def _hand_over(self, closed):
+        if self.on_batch is not None:
+            for batch in closed:
+                self.on_batch(batch)
+        return closed
 
 
 class RiderManagement:
-    def __init__(self, db_url):
-        engine = create_engine(db_url)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+    def __init__(self, db_url, session=None, rider_pool=None):
+        self.session = session if session is not None else get_session(db_url)
+        if rider_pool is None:
+            rider_pool = RiderPool(self.session)
+            rider_pool.load()
+        self.rider_pool = rider_pool
+        self.batcher = DeliveryBatcher()
+        self._queued = set()
+        self._process_lock = threading.Lock()
+        self._stop_dispatching = threading.Event()
+        self._dispatcher = None
 
 
     def assign_rider_to_order(self, order):
 
+        message = self.assign_rider_to_batch(
+            DeliveryBatch(address_postal_code(order.customer_address), (order.Id,), len(order.pizzas), datetime.datetime.now())
+        )
+        return message
+
+
+    def assign_rider_to_batch(self, batch):
+        # One rider delivers every order of the batch
+        self._queued.difference_update(batch.order_ids)
+        rider_id = self.rider_pool.acquire(batch.postal_code)
+        if rider_id is None:
+            return f"No riders available for postal code {batch.postal_code} at the moment."
+
+        writes = {}
         try:
-            rider = self.session.query(Rider).filter_by(available=True).first()
-
-            if rider:
-                order.rider = rider
-                order.assigned_time = datetime.datetime.now()
-                rider.available = False
-                self.session.commit()
-                return f"Rider {rider.name} assigned to order {order.id}."
-            else:
-                return "No riders available at the moment."
-
-        except IntegrityError as e:
+            # Before the update, the acquired rider's previous orders are delivered as well
+            writes, delivered = self._flush_riders(rider_id)
+            self.session.execute(
+                update(Order)
+                .where(Order.Id.in_(batch.order_ids))
+                .values(rider_id=rider_id, dispatched_at=datetime.datetime.now(), status="Out for Delivery")
+            )
+            self.session.commit()
+            order_changes.publish(tuple(batch.order_ids) + delivered)
+            order_list = ", ".join(str(order_id) for order_id in batch.order_ids)
+            return f"Rider {rider_id} assigned to order {order_list}."
+
+        except Exception as e:
+            # Whatever failed, the rider goes back to the pool so memory and database stay in step
             self.session.rollback()
+            self.rider_pool.restore(writes)
+            self.rider_pool.release(rider_id)
             return f"Error assigning rider: {e}"
 
 
     def release_rider(self,rider):
-        rider.available = True
-        self.session.commit()
+        if self.rider_pool.release(rider.Id):
+            self.sync()
+
+
+    def sync(self):
+        # Pushes riders whose cooldown is over back to the database
+        writes = {}
+        try:
+            writes, delivered = self._flush_riders()
+            self.session.commit()
+            order_changes.publish(delivered)
+        except Exception as e:
+            self.session.rollback()
+            self.rider_pool.restore(writes)
+            print(f"An error occurred while syncing riders: {e}")
+
+
+    def _flush_riders(self, *returned):
+        # A rider that is available again has delivered the orders it went out with, the caller commits
+        writes = self.rider_pool.flush()
+        returned = list(returned) + [rider_id for rider_id, available in writes.items() if available]
+        if not returned:
+            return writes, ()
+        delivered = tuple(self.session.scalars(
+            select(Order.Id).where(Order.rider_id.in_(returned), Order.status == "Out for Delivery")
+        ))
+        if delivered:
+            self.session.execute(update(Order).where(Order.Id.in_(delivered)).values(status="Delivered"))
+        return writes, delivered
+
+
+    def process_orders(self, dispatch_open=False):
+        # Prepared orders go into the batcher and closed batches are dispatched, returns one message per batch.
+        # Polled by the dispatch thread, staff dispatching by hand pass dispatch_open=True to send open batches too.
+        with self._process_lock:
+            prepared_orders = self.session.execute(
+                select(Order.Id, Order.order_date, Order.customer_address,
+                       func.coalesce(func.sum(order_pizzas.c.Quantity), 0))
+                .outerjoin(order_pizzas, order_pizzas.c.OrderId == Order.Id)
+                .where(Order.current_status == "Prepared", Order.rider_id.is_(None))
+                .group_by(Order.Id, Order.order_date, Order.customer_address)
+                .order_by(Order.order_date, Order.Id)
+            ).all()
+            closed = []
+            for order_id, order_date, address, pizza_count in prepared_orders:
+                if order_id in self._queued:
+                    continue
+                self._queued.add(order_id)
+                # Every order takes as long to prepare, so windows from the prepared time group the same
+                # orders as windows from the order time
+                closed += self.batcher.add(order_id, address_postal_code(address), pizza_count,
+                                           now=order_date + PREPARED_AFTER)
+            closed += self.batcher.close_all() if dispatch_open else self.batcher.close_expired()
+            messages = [self.assign_rider_to_batch(batch) for batch in closed]
+            self.sync()
+            return messages
 
+    def start_dispatching(self, interval=DISPATCH_INTERVAL):
+        # Runs process_orders every interval seconds on a daemon thread until stop_dispatching()
+        if self._dispatcher is not None and self._dispatcher.is_alive():
+            return
+        self._stop_dispatching.clear()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, args=(interval,), daemon=True)
+        self._dispatcher.start()
 
-    def process_orders(self):
-        prepared_orders = self.session.query(Order).filter_by(label="prepared").all()
-        for order in prepared_orders:
-            if not order.rider:
-                message = self.assign_rider_to_order(order)
-                print(message)
-            elif order.rider and order.assigned_time and (datetime.datetime.now() - order.assigned_time) > datetime.timedelta(minutes=20):
-                self.release_rider(order.rider)
-                print(f"Rider {order.rider.name} released from order {order.id}.")
+    def stop_dispatching(self):
+        self._stop_dispatching.set()
 
+    def _dispatch_loop(self, interval):
+        while not self._stop_dispatching.wait(interval):
+            try:
+                for message in self.process_orders():
+                    print(message)
+            except Exception as e:
+                self.session.rollback()
+                print(f"An error occurred while dispatching orders: {e}")
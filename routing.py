@@ -0,0 +1,137 @@
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from database import get_session
+from models import Order, PostalCodeLocation
+from riders import BATCH_WINDOW, PREPARED_AFTER, address_postal_code, normalize_postal_code
+
+# Where the riders leave from, and the timing assumptions used for the ETAs
+RESTAURANT_COORDINATES = (50.8514, 5.6910)
+AVERAGE_SPEED_KMH = 20.0
+MINUTES_PER_STOP = 2.0
+# An order that was not dispatched yet leaves once it is prepared and its batch window has closed,
+# the latest the DeliveryBatcher sends it
+DEPARTURE_AFTER = PREPARED_AFTER + BATCH_WINDOW
+EARTH_RADIUS_KM = 6371.0
+
+# Approximate centres of the Maastricht postal code areas (first four characters of the postal code),
+# written to the postal_codes table by migrations.seed_postal_codes. Full codes in the table win.
+POSTAL_CODE_COORDINATES = {
+    "6211": (50.8510, 5.6900), "6212": (50.8430, 5.6850), "6213": (50.8440, 5.6650),
+    "6214": (50.8530, 5.6760), "6215": (50.8390, 5.6690), "6216": (50.8570, 5.6490),
+    "6217": (50.8650, 5.6660), "6218": (50.8720, 5.6820), "6219": (50.8610, 5.6920),
+    "6221": (50.8480, 5.7020), "6222": (50.8560, 5.7140), "6223": (50.8760, 5.7080),
+    "6224": (50.8580, 5.7380), "6225": (50.8450, 5.7270), "6226": (50.8350, 5.7220),
+    "6227": (50.8400, 5.7390), "6228": (50.8260, 5.7150), "6229": (50.8340, 5.7080),
+}
+
+
+def distance_matrix(coordinates):
+    # Haversine distances in km between all (latitude, longitude) pairs
+    radians = np.radians(np.asarray(coordinates, dtype=np.float64))
+    latitudes = radians[:, 0][:, None]
+    longitudes = radians[:, 1][:, None]
+    a = (np.sin((latitudes - latitudes.T) / 2) ** 2
+         + np.cos(latitudes) * np.cos(latitudes.T) * np.sin((longitudes - longitudes.T) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def nearest_neighbour_route(distances):
+    # Open route that starts at index 0 (the restaurant)
+    count = len(distances)
+    visited = np.zeros(count, dtype=bool)
+    visited[0] = True
+    route = [0]
+    for _ in range(count - 1):
+        remaining = np.where(visited, np.inf, distances[route[-1]])
+        nearest = int(np.argmin(remaining))
+        visited[nearest] = True
+        route.append(nearest)
+    return np.array(route)
+
+
+def two_opt(route, distances):
+    # Reverses route segments while that makes the open route shorter, the start stays fixed
+    route = route.copy()
+    count = len(route)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, count - 1):
+            before, first = route[i - 1], route[i]
+            ends = np.arange(i + 1, count)
+            last = route[ends]
+            has_next = ends + 1 < count
+            after = route[np.minimum(ends + 1, count - 1)]
+            delta = (distances[before, last] - distances[before, first]
+                     + np.where(has_next, distances[first, after] - distances[last, after], 0.0))
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                end = ends[best]
+                route[i:end + 1] = route[i:end + 1][::-1]
+                improved = True
+    return route
+
+
+class RoutePlanner:
+    # Orders the stops of a delivery batch using the coordinates in the postal_codes table
+    def __init__(self, db_url, session=None):
+        self.session = session if session is not None else get_session(db_url)
+        self._coordinates = None
+        self._missing = set()
+        self._lock = threading.Lock()
+
+    def load_coordinates(self):
+        if self._coordinates is None:
+            with self._lock:
+                if self._coordinates is None:
+                    self._coordinates = {
+                        normalize_postal_code(postal_code): (latitude, longitude)
+                        for postal_code, latitude, longitude in self.session.execute(
+                            select(PostalCodeLocation.postal_code, PostalCodeLocation.latitude,
+                                   PostalCodeLocation.longitude))
+                    }
+        return self._coordinates
+
+    def coordinates(self, postal_code):
+        self.load_coordinates()
+        postal_code = normalize_postal_code(postal_code)
+        coordinates = self._coordinates.get(postal_code) or self._coordinates.get(postal_code[:4])
+        if coordinates is None:
+            # Unknown postal codes are treated as being at the restaurant, which makes their ETAs too short
+            if postal_code not in self._missing:
+                self._missing.add(postal_code)
+                print(f"WARNING: no coordinates for postal code '{postal_code}', using the restaurant location")
+            return RESTAURANT_COORDINATES
+        return coordinates
+
+    def plan(self, stops):
+        # stops is a list of (order id, postal code). Returns [(order id, minutes after departure)]
+        # in delivery order.
+        if not stops:
+            return []
+        points = [RESTAURANT_COORDINATES] + [self.coordinates(postal_code) for _, postal_code in stops]
+        distances = distance_matrix(points)
+        route = two_opt(nearest_neighbour_route(distances), distances)
+        legs = distances[route[:-1], route[1:]]
+        minutes = np.cumsum(legs / AVERAGE_SPEED_KMH * 60 + MINUTES_PER_STOP)
+        return [(stops[index - 1][0], float(eta)) for index, eta in zip(route[1:], minutes)]
+
+    def estimated_delivery(self, order_id, now=None):
+        now = now or datetime.now()
+        order = self.session.query(Order).filter_by(Id=order_id).one()
+        if order.dispatched_at is not None:
+            # Plan the whole batch this order went out with
+            batch = self.session.execute(
+                select(Order.Id, Order.customer_address)
+                .where(Order.rider_id == order.rider_id, Order.dispatched_at == order.dispatched_at)
+            ).all()
+            departure = order.dispatched_at
+        else:
+            batch = [(order.Id, order.customer_address)]
+            departure = max(now, order.order_date + DEPARTURE_AFTER)
+        etas = dict(self.plan([(batch_order_id, address_postal_code(address)) for batch_order_id, address in batch]))
+        return departure + timedelta(minutes=etas[order.Id])
@@ -1,24 +1,25 @@
 from datetime import datetime
+from decimal import Decimal
 
-from sqlalchemy import create_engine, extract
-from sqlalchemy.sql import func
-from sqlalchemy.orm import sessionmaker
-
+from change_feed import order_changes
+from database import get_session
+from earnings import EarningsRollup
 from models import Order
+from order import OrderStatusTracker
 
 
 class StaffOp:
-	def __init__(self, db_url):
-		engine = create_engine(db_url)
-		session = sessionmaker(bind=engine)
-		self.session = session()
+	def __init__(self, db_url, session=None):
+		self.session = session if session is not None else get_session(db_url)
+		self.earnings_rollup = EarningsRollup(db_url, session=self.session)
+		self.order_tracker = OrderStatusTracker(db_url, session=self.session)
 
 	def display_pending_orders(self):
 		try:
 			pending_orders = (
 				self.session.query(Order)
-				.filter(Order.status != "Delivered")
-				.order_by(Order.status)
+				.filter(Order.current_status.notin_(["Delivered", "Cancelled"]))
+				.order_by(Order.current_status)
 				.all()
 			)
 			return pending_orders
@@ -26,22 +27,47 @@ class StaffOp:
 			print(f"An error occurred while displaying pending orders: {e}")
 			return []
 
-	def generate_monthly_earnings_report(self, postal_code_prefix=None):
-
+	def pending_order_changes(self, cursor=None):
+		# Returns (cursor, changed pending orders, ids to drop from the display). With cursor None,
+		# or a cursor the change feed no longer covers, all pending orders are returned and the ids
+		# to drop are None, the caller replaces what it shows instead of merging.
 		try:
+			new_cursor, changed_ids = order_changes.changes_since(cursor)
+			if changed_ids is None:
+				return new_cursor, self.display_pending_orders(), None
+			if not changed_ids:
+				return new_cursor, [], set()
+			changed_orders = (
+				self.session.query(Order)
+				.filter(Order.Id.in_(changed_ids), Order.current_status.notin_(["Delivered", "Cancelled"]))
+				.all()
+			)
+			removed_ids = changed_ids - {order.Id for order in changed_orders}
+			return new_cursor, changed_orders, removed_ids
+		except Exception as e:
+			print(f"An error occurred while fetching pending order changes: {e}")
+			return cursor, [], set()
 
-			current_month = datetime.now().month
-			current_year = datetime.now().year
-			query = self.session.query(func.sum(Order.total_price)) \
-				.filter(extract("month", Order.order_date) == current_month) \
-				.filter(extract("year", Order.order_date) == current_year)
+	def subscribe_to_order_changes(self, callback):
+		# callback(sequence, order_ids) is called from the thread that changed the orders
+		order_changes.subscribe(callback)
 
-			if postal_code_prefix:
-				query = query.filter(Order.postal_code.like(f"{postal_code_prefix}%"))
+	def unsubscribe_from_order_changes(self, callback):
+		order_changes.unsubscribe(callback)
 
-			monthly_earnings = query.scalar
-			return monthly_earnings if monthly_earnings else 0.0
+	def confirm_delivery(self, order_id):
+		# For deliveries the rider reports before coming back, riders returning confirm theirs on their own
+		return self.order_tracker.confirm_delivery(order_id)
+
+	def generate_monthly_earnings_report(self, postal_code_prefix=None, gender=None, age_bucket=None):
+
+		try:
+
+			now = datetime.now()
+			return self.earnings_rollup.monthly_earnings(
+				now.year, now.month, postal_code_prefix=postal_code_prefix, gender=gender, age_bucket=age_bucket
+			)
 
 		except Exception as e:
 			print(f"An error occurred while generating monthly earnings report: {e}")
-			return 0.0
\ No newline at end of file
+			return Decimal('0.00')
@@ -0,0 +1,40 @@
+import os
+import sys
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import get_session
+from menu_cache import menu_cache
+from migrations import migrate
+from models import Customer, Dessert, DeliveryPersonnel, Drink, Ingredient, Pizza
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    # A migrated SQLite file per test with a small menu, two customers and one rider
+    db_url = f"sqlite:///{tmp_path / 'pizza.db'}"
+    migrate(db_url)
+    session = get_session(db_url)
+    ingredients = [Ingredient(name=f"Ingredient {i}", cost=Decimal('1.00') * i, is_vegetarian=True, is_vegan=i % 2 == 0)
+                   for i in range(1, 5)]
+    pizzas = [Pizza(name=f"Pizza {i}", is_vegetarian=True, is_vegan=False, price=Decimal('0')) for i in range(1, 4)]
+    for index, pizza in enumerate(pizzas):
+        pizza.ingredients = ingredients[:index + 2]
+    session.add_all(ingredients + pizzas)
+    session.add(Drink(name="Cola", price=Decimal('2.50')))
+    session.add(Dessert(name="Tiramisu", price=Decimal('4.00')))
+    for name, gender, address in [("Ann", "F", "6211AB Markt 1"), ("Bob", "M", "6221CD Wyck 2")]:
+        customer = Customer(name=name, gender=gender, birthdate=datetime(1990, 1, 1), address=address)
+        customer.set_pw("secret")
+        session.add(customer)
+    session.add(DeliveryPersonnel(name="Rider", postalCode="6211AB", available=True))
+    session.commit()
+    session.remove()
+    # The menu cache is process wide, the snapshot of the previous test's database must not be used
+    menu_cache.bump()
+    yield db_url
+    session.remove()
@@ -0,0 +1,89 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from analytics import EarningsCube
+from database import get_session
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+
+
+def loaded_cube():
+    cube = EarningsCube(capacity=2)
+    cube.loaded = True
+    return cube
+
+
+def append(cube, order_id, total, address="6211AB Markt 1", gender="F", birthdate=datetime(1990, 1, 1),
+           order_date=datetime(2024, 10, 7, 18, 0)):
+    cube.append(order_id, order_date, Decimal(total), address, gender, birthdate)
+
+
+def test_slices_and_groups():
+    cube = loaded_cube()
+    append(cube, 1, "10.00")
+    append(cube, 2, "5.50", address="6221CD Wyck 2", gender="M", birthdate=datetime(1950, 1, 1))
+    append(cube, 3, "2.25", order_date=datetime(2024, 11, 1, 12, 0))
+    assert cube.earnings() == Decimal('17.75')
+    assert cube.earnings(start=date(2024, 10, 1), end=date(2024, 11, 1)) == Decimal('15.50')
+    assert cube.earnings(postal_code_prefix="622") == Decimal('5.50')
+    assert cube.earnings(gender="f", max_age=40) == Decimal('12.25')
+    assert cube.earnings(postal_code_prefix="999") == Decimal('0.00')
+    assert cube.earnings(group_by=("month", "gender")) == {
+        ("2024-10", "f"): Decimal('10.00'), ("2024-10", "m"): Decimal('5.50'), ("2024-11", "f"): Decimal('2.25')
+    }
+    assert cube.earnings(group_by=("age_bucket",)) == {("25-34",): Decimal('12.25'), ("65+",): Decimal('5.50')}
+    with pytest.raises(ValueError):
+        cube.earnings(group_by=("customer",))
+
+
+def test_remove_order_appended_out_of_id_order():
+    cube = loaded_cube()
+    for order_id in (1, 3, 2):
+        append(cube, order_id, "1.00")
+    cube.remove_order(2)
+    assert cube.earnings() == Decimal('2.00')
+    # Unknown ids are ignored
+    cube.remove_order(42)
+    assert cube.earnings() == Decimal('2.00')
+
+
+def test_orders_before_load_are_not_appended_twice():
+    cube = EarningsCube()
+    append(cube, 1, "1.00")
+    assert cube.earnings() == Decimal('0.00')
+    cube.loaded = True
+    append(cube, 1, "1.00")
+    append(cube, 1, "1.00")
+    assert cube.earnings() == Decimal('1.00')
+
+
+def test_load_and_follow_new_and_cancelled_orders(db_url):
+    session = get_session(db_url)
+    cube = EarningsCube()
+    pizza_service = PizzaService(db_url, session=session, earnings_cube=cube,
+                                 order_status_tracker=OrderStatusTracker(db_url, session=session))
+    cart = [{'type': 'Pizza', 'id': 1, 'quantity': 1}, {'type': 'Drink', 'id': 1, 'quantity': 1}]
+    first = pizza_service.create_order(1, cart)
+    cube.load(session)
+    second = pizza_service.create_order(2, cart)
+    assert cube.earnings() == first['total_price'] + second['total_price']
+
+    pizza_service.cancel_order(first['order_id'])
+    assert cube.earnings() == second['total_price']
+    assert cube.earnings(postal_code_prefix="622") == second['total_price']
+
+
+def test_order_committed_during_load_is_kept_once():
+    cube = EarningsCube()
+    row = (7, datetime(2024, 10, 7, 18, 0), Decimal('3.00'), "6211AB Markt 1", "F", datetime(1990, 1, 1))
+
+    class Session:
+        def execute(self, query):
+            # Committed and appended after the load started, and also read by the load's query
+            cube.append(*row)
+            return [row]
+
+    cube.load(Session())
+    assert cube.earnings() == Decimal('3.00')
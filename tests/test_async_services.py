@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from decimal import Decimal
+
+from async_services import AsyncOrderStatusTracker, AsyncPizzaService, AsyncStaffOp
+from database import get_async_engine
+from menu_cache import menu_cache
+
+
+def run(db_url, coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            # The engine's connections belong to this loop
+            await get_async_engine(db_url).dispose()
+    return asyncio.run(main())
+
+
+def test_create_fetch_and_cancel_order(db_url):
+    async def scenario():
+        tracker = AsyncOrderStatusTracker(db_url)
+        pizza_service = AsyncPizzaService(db_url, order_status_tracker=tracker)
+        staff_op = AsyncStaffOp(db_url)
+
+        pizzas = await pizza_service.fetch_pizzas()
+        assert [pizza.name for pizza in pizzas] == ["Pizza 1", "Pizza 2", "Pizza 3"]
+
+        confirmation = await pizza_service.create_order(1, [{'type': 'Pizza', 'id': pizzas[0].Id, 'quantity': 2},
+                                                            {'type': 'Drink', 'id': 1, 'quantity': 1}])
+        order_id = confirmation['order_id']
+        assert await tracker.get_order_status(order_id) == "Pending"
+        assert await tracker.get_order_count(1) == 1
+        assert [order.Id for order in await staff_op.display_pending_orders()] == [order_id]
+
+        assert await pizza_service.cancel_order(order_id)
+        assert await tracker.get_order_count(1) == 0
+        assert await staff_op.display_pending_orders() == []
+
+    run(db_url, scenario())
+
+
+def test_concurrent_orders_share_the_loop(db_url):
+    async def scenario():
+        pizza_service = AsyncPizzaService(db_url)
+        confirmations = await asyncio.gather(*[
+            pizza_service.create_order(customer_id, [{'type': 'Pizza', 'id': 1, 'quantity': 1}])
+            for customer_id in (1, 2, 1, 2)
+        ])
+        assert len({confirmation['order_id'] for confirmation in confirmations}) == 4
+        assert await pizza_service.order_status_tracker.get_order_count(1) == 2
+
+    run(db_url, scenario())
+
+
+def test_menu_reads_and_writes_do_not_deadlock(db_url):
+    # A reload awaits the database with the menu cache stale, writers bump the cache on the same loop thread
+    async def scenario():
+        pizza_service = AsyncPizzaService(db_url)
+        for round_number in range(5):
+            menu_cache.bump()
+            results = await asyncio.gather(
+                pizza_service.fetch_pizzas(),
+                pizza_service.add_pizza(f"Special {round_number}", True, False, Decimal('9.50')),
+                pizza_service.fetch_drinks(),
+                pizza_service.update_pizza(1, price=Decimal('8.00') + round_number),
+            )
+            assert results[0]
+        names = [pizza.name for pizza in await pizza_service.fetch_pizzas()]
+        assert names[-5:] == [f"Special {round_number}" for round_number in range(5)]
+
+    # A deadlock blocks the loop thread itself, so the scenario gets its own thread to be able to time out
+    errors = []
+    worker = threading.Thread(target=lambda: _capture(errors, run, db_url, scenario()), daemon=True)
+    worker.start()
+    worker.join(timeout=30)
+    assert not worker.is_alive(), "menu reads and writes deadlocked"
+    assert errors == []
+
+
+def _capture(errors, function, *args):
+    try:
+        function(*args)
+    except Exception as error:
+        errors.append(error)
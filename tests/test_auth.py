@@ -0,0 +1,68 @@
+import threading
+from datetime import timedelta
+
+import pytest
+
+import models
+from auth import AuthService
+from database import get_session
+from models import Customer, password_rounds
+
+
+@pytest.fixture
+def auth_service(db_url):
+    auth_service = AuthService(db_url)
+    yield auth_service
+    auth_service.shutdown()
+
+
+def test_login_issues_a_token_for_its_role(auth_service):
+    role, customer_id, token = auth_service.login_customer(" ann ", "secret").result(timeout=10)
+    assert (role, customer_id) == ("customer", 1)
+    assert auth_service.validate_token(token) == 1
+    assert auth_service.validate_token(token, "customer") == 1
+    assert auth_service.validate_token(token, "admin") is None
+
+    auth_service.revoke_token(token)
+    assert auth_service.validate_token(token) is None
+
+
+def test_wrong_password_or_user(auth_service):
+    assert auth_service.login_customer("Ann", "wrong").result(timeout=10) is False
+    assert auth_service.login_customer("Nobody", "secret").result(timeout=10) is False
+    assert auth_service.login_admin("Ann", "secret").result(timeout=10) is False
+
+
+def test_callback_gets_the_result(auth_service):
+    results = []
+    done = threading.Event()
+
+    def callback(result):
+        results.append(result)
+        done.set()
+
+    auth_service.login_customer("Bob", "secret", callback=callback)
+    assert done.wait(10)
+    assert results[0][:2] == ("customer", 2)
+
+
+def test_expired_tokens_are_rejected(db_url):
+    auth_service = AuthService(db_url, token_lifetime=timedelta(0))
+    try:
+        _, _, token = auth_service.login_customer("Ann", "secret").result(timeout=10)
+        assert auth_service.validate_token(token) is None
+        assert token not in auth_service._tokens
+    finally:
+        auth_service.shutdown()
+
+
+def test_login_rehashes_with_the_current_work_factor(db_url, auth_service, monkeypatch):
+    session = get_session(db_url)
+    assert password_rounds(session.get(Customer, 1).password) == models.BCRYPT_ROUNDS
+    monkeypatch.setattr(models, "BCRYPT_ROUNDS", 4)
+    assert auth_service.login_customer("Ann", "secret").result(timeout=10)
+
+    session.expire_all()
+    assert password_rounds(session.get(Customer, 1).password) == 4
+    # The new hash still checks the same password
+    assert auth_service.login_customer("Ann", "secret").result(timeout=10)
@@ -0,0 +1,47 @@
+from change_feed import OrderChangeFeed
+
+
+def test_changes_since_returns_ids_after_cursor():
+    feed = OrderChangeFeed()
+    cursor, changed = feed.changes_since(None)
+    assert changed is None
+
+    feed.publish([1, 2])
+    feed.publish([3])
+    new_cursor, changed = feed.changes_since(cursor)
+    assert new_cursor == 2
+    assert changed == {1, 2, 3}
+    assert feed.changes_since(new_cursor) == (2, set())
+
+
+def test_empty_publish_does_not_move_the_sequence():
+    feed = OrderChangeFeed()
+    assert feed.publish([]) == 0
+    assert feed.sequence == 0
+
+
+def test_cursor_older_than_the_log_asks_for_a_reload():
+    feed = OrderChangeFeed(log_size=2)
+    cursor, _ = feed.changes_since(None)
+    for order_id in range(1, 4):
+        feed.publish([order_id])
+    assert feed.changes_since(cursor) == (3, None)
+    assert feed.changes_since(2) == (3, {3})
+
+
+def test_subscribers_get_sequence_and_ids():
+    feed = OrderChangeFeed()
+    received = []
+
+    def broken(sequence, order_ids):
+        raise RuntimeError("subscriber failed")
+
+    def callback(sequence, order_ids):
+        received.append((sequence, order_ids))
+
+    feed.subscribe(broken)
+    feed.subscribe(callback)
+    feed.publish([7])
+    feed.unsubscribe(callback)
+    feed.publish([8])
+    assert received == [(1, [7])]
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+from riders import DeliveryBatcher
+
+START = datetime(2024, 10, 7, 18, 0)
+
+
+def test_batch_closes_when_window_expires():
+    batcher = DeliveryBatcher(window=timedelta(minutes=3), max_pizzas=3)
+    assert batcher.add(1, "6211 ab", 1, now=START) == []
+    assert batcher.add(2, "6211AB", 1, now=START + timedelta(minutes=1)) == []
+    assert batcher.close_expired(now=START + timedelta(minutes=2)) == []
+
+    batches = batcher.close_expired(now=START + timedelta(minutes=3))
+    assert [(batch.postal_code, batch.order_ids, batch.pizza_count) for batch in batches] == [("6211AB", (1, 2), 2)]
+    assert batcher.open_batches() == 0
+
+
+def test_late_order_closes_the_expired_batch_first():
+    batcher = DeliveryBatcher(window=timedelta(minutes=3), max_pizzas=3)
+    batcher.add(1, "6211AB", 1, now=START)
+    batches = batcher.add(2, "6211AB", 1, now=START + timedelta(minutes=5))
+    assert [batch.order_ids for batch in batches] == [(1,)]
+    assert batcher.open_batches() == 1
+
+
+def test_pizza_cap_closes_the_batch():
+    handed_over = []
+    batcher = DeliveryBatcher(on_batch=handed_over.append, max_pizzas=3)
+    batcher.add(1, "6211AB", 2, now=START)
+    # Would go over the cap, the open batch goes without it
+    batches = batcher.add(2, "6211AB", 2, now=START)
+    assert [batch.order_ids for batch in batches] == [(1,)]
+    batches = batcher.add(3, "6211AB", 1, now=START)
+    assert [batch.order_ids for batch in batches] == [(2, 3)]
+    assert [batch.order_ids for batch in handed_over] == [(1,), (2, 3)]
+    # The deadline of a batch closed by the cap is skipped
+    assert batcher.close_expired(now=START + timedelta(hours=1)) == []
+
+
+def test_close_all_sends_every_open_batch():
+    batcher = DeliveryBatcher()
+    batcher.add(1, "6211AB", 1, now=START)
+    batcher.add(2, "6221CD", 1, now=START)
+    batches = batcher.close_all()
+    assert sorted(batch.postal_code for batch in batches) == ["6211AB", "6221CD"]
+    assert batcher.close_expired(now=START + timedelta(hours=1)) == []
+
@@ -0,0 +1,79 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+import earnings
+from database import get_engine, get_session
+from earnings import EarningsRollup, age_bucket, check_postal_prefix
+from migrations import backfill_earnings_rollup
+from models import DailyEarnings
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+
+
+@pytest.fixture
+def pizza_service(db_url):
+    session = get_session(db_url)
+    return PizzaService(db_url, session=session, order_status_tracker=OrderStatusTracker(db_url, session=session))
+
+
+def place_orders(pizza_service):
+    # Two orders for Ann (prefix 621), one for Bob (prefix 622)
+    return [
+        pizza_service.create_order(customer_id, [{'type': 'Pizza', 'id': 1, 'quantity': 1},
+                                                 {'type': 'Drink', 'id': 1, 'quantity': quantity}])
+        for customer_id, quantity in [(1, 1), (1, 2), (2, 1)]
+    ]
+
+
+def report(pizza_service, **filters):
+    now = datetime.now()
+    return pizza_service.earnings_rollup.monthly_earnings(now.year, now.month, **filters)
+
+
+@pytest.mark.parametrize("upsert", [True, False])
+def test_orders_are_added_to_and_removed_from_the_rollup(pizza_service, monkeypatch, upsert):
+    if not upsert:
+        # The select-for-update path of dialects without an upsert
+        monkeypatch.setattr(earnings, "UPSERT_DIALECTS", {})
+    orders = place_orders(pizza_service)
+    totals = [order['total_price'] for order in orders]
+    assert report(pizza_service) == sum(totals)
+    assert report(pizza_service, postal_code_prefix="621") == totals[0] + totals[1]
+    assert report(pizza_service, postal_code_prefix="622", gender="M") == totals[2]
+    assert report(pizza_service, postal_code_prefix="622", gender="F") == Decimal('0.00')
+    rows = pizza_service.session.query(DailyEarnings).filter_by(postal_prefix="621").all()
+    assert [row.order_count for row in rows] == [2]
+
+    assert pizza_service.cancel_order(orders[1]['order_id'])
+    assert report(pizza_service, postal_code_prefix="621") == totals[0]
+
+
+def test_postal_prefix_must_be_three_characters(pizza_service):
+    for prefix in ("62", "6211"):
+        with pytest.raises(ValueError):
+            report(pizza_service, postal_code_prefix=prefix)
+    assert check_postal_prefix(" 621 ") == "621"
+
+
+def test_backfill_rebuilds_the_rollup_from_the_orders(db_url, pizza_service):
+    orders = place_orders(pizza_service)
+    pizza_service.cancel_order(orders[0]['order_id'])
+    expected = {(row.postal_prefix, row.order_count, row.earnings)
+                for row in pizza_service.session.query(DailyEarnings) if row.order_count}
+    pizza_service.session.query(DailyEarnings).delete()
+    pizza_service.session.commit()
+
+    backfill_earnings_rollup(get_engine(db_url))
+    pizza_service.session.expire_all()
+    assert {(row.postal_prefix, row.order_count, row.earnings)
+            for row in pizza_service.session.query(DailyEarnings)} == expected
+    assert EarningsRollup(db_url, session=pizza_service.session).monthly_earnings(
+        datetime.now().year, datetime.now().month) == orders[1]['total_price'] + orders[2]['total_price']
+
+
+def test_age_bucket():
+    assert age_bucket(datetime(2000, 6, 1), datetime(2024, 5, 31)) == "18-24"
+    assert age_bucket(datetime(2000, 6, 1), datetime(2025, 6, 1)) == "25-34"
+    assert age_bucket(datetime(1950, 1, 1), datetime(2024, 1, 1)) == "65+"
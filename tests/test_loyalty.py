@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+from database import get_session
+from loyalty import LOYALTY_DISCOUNT, PIZZAS_FOR_DISCOUNT, LoyaltyLedger, count_pizzas
+from models import LoyaltyAccount
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+
+
+def test_count_pizzas_earns_and_uses_the_discount():
+    discount, state = count_pizzas((0, False), PIZZAS_FOR_DISCOUNT - 1)
+    assert (discount, state) == (Decimal('0'), (PIZZAS_FOR_DISCOUNT - 1, False))
+    discount, state = count_pizzas(state, 2)
+    assert (discount, state) == (Decimal('0'), (1, True))
+    discount, state = count_pizzas(state, 1)
+    assert (discount, state) == (LOYALTY_DISCOUNT, (2, False))
+
+
+def test_record_order_updates_the_account(db_url):
+    session = get_session(db_url)
+    ledger = LoyaltyLedger(db_url, session=session)
+    assert ledger.record_order(1, 4) == (Decimal('0'), (4, False))
+    session.commit()
+    account = session.get(LoyaltyAccount, 1)
+    assert (account.pizza_count, account.discount_earned) == (4, False)
+
+
+def test_cancelled_order_is_taken_out_of_the_count(db_url):
+    session = get_session(db_url)
+    pizza_service = PizzaService(db_url, session=session,
+                                 order_status_tracker=OrderStatusTracker(db_url, session=session))
+    ledger = pizza_service.loyalty_ledger
+    pizza_service.create_order(1, [{'type': 'Pizza', 'id': 1, 'quantity': PIZZAS_FOR_DISCOUNT}])
+    assert ledger.has_discount(1)
+
+    confirmation = pizza_service.create_order(1, [{'type': 'Pizza', 'id': 1, 'quantity': 1}])
+    assert confirmation['is_discount_applied']
+    assert not ledger.has_discount(1)
+
+    # Cancelling gives back the discount the order used
+    assert pizza_service.cancel_order(confirmation['order_id'])
+    assert ledger.has_discount(1)
+    account = session.get(LoyaltyAccount, 1)
+    session.refresh(account)
+    assert (account.pizza_count, account.discount_earned) == (0, True)
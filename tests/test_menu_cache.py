@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+from database import get_session
+from menu_cache import MenuCache, PizzaRecord
+from models import Drink
+
+
+def test_get_returns_records(db_url):
+    cache = MenuCache()
+    session = get_session(db_url)
+    pizzas = cache.get(session, "Pizza")
+    assert [pizza.name for pizza in pizzas] == ["Pizza 1", "Pizza 2", "Pizza 3"]
+    assert all(isinstance(pizza, PizzaRecord) for pizza in pizzas)
+    assert cache.get(session, "Drink")[0].price == Decimal('2.50')
+    assert cache.get(session, "Unknown") == ()
+
+
+def test_snapshot_is_reused_until_bumped(db_url):
+    cache = MenuCache(ttl=None)
+    session = get_session(db_url)
+    drinks = cache.get(session, "Drink")
+    session.add(Drink(name="Water", price=Decimal('1.50')))
+    session.commit()
+    assert cache.get(session, "Drink") is drinks
+
+    cache.bump()
+    assert [drink.name for drink in cache.get(session, "Drink")] == ["Cola", "Water"]
+
+
+def test_expired_snapshot_is_reloaded(db_url):
+    cache = MenuCache(ttl=0)
+    session = get_session(db_url)
+    drinks = cache.get(session, "Drink")
+    assert cache.get(session, "Drink") is not drinks
+
+
+def test_bump_during_reload_leaves_the_snapshot_stale(db_url):
+    # A writer that bumps while a reload is querying, on the same thread as under AsyncSession.run_sync
+    cache = MenuCache(ttl=None)
+    session = get_session(db_url)
+
+    class BumpingSession:
+        def execute(self, statement):
+            if cache.version == 0:
+                cache.bump()
+            return session.execute(statement)
+
+    drinks = cache.get(BumpingSession(), "Drink")
+    reloaded = cache.get(session, "Drink")
+    assert reloaded is not drinks
+    assert cache.get(session, "Drink") is reloaded
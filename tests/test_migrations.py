@@ -0,0 +1,44 @@
+from sqlalchemy import create_engine, inspect, text
+
+from database import get_engine
+from migrations import MIGRATIONS, _has_index, add_hot_path_indexes, add_order_tracking_columns, check_schema, \
+    current_versions, migrate
+from models import Order
+
+
+def test_order_tracking_columns_match_existing_columns_in_any_case(tmp_path):
+    # The old orders table from the MySQL dump already has a lowercase `status`
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE orders (Id INTEGER PRIMARY KEY, status VARCHAR(32) NOT NULL DEFAULT 'Pending')"))
+    add_order_tracking_columns(engine)
+    add_order_tracking_columns(engine)
+    columns = [column['name'] for column in inspect(engine).get_columns('orders')]
+    assert columns == ['Id', 'status', 'RiderId', 'DispatchedAt']
+    engine.dispose()
+
+
+def test_migrate_twice_is_a_no_op(db_url):
+    engine = get_engine(db_url)
+    assert current_versions(engine) == {version for version, _, _ in MIGRATIONS}
+    migrate(db_url)
+    assert current_versions(engine) == {version for version, _, _ in MIGRATIONS}
+    assert check_schema(db_url) == []
+
+
+def test_check_schema_warns_about_a_dropped_index(db_url):
+    engine = get_engine(db_url)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_orders_Status_OrderDate"))
+    assert check_schema(db_url) == ["Missing index ix_orders_Status_OrderDate on orders"]
+    add_hot_path_indexes(engine)
+    assert check_schema(db_url) == []
+
+
+def test_existing_index_is_found_whatever_the_case_of_its_columns(db_url):
+    engine = get_engine(db_url)
+    index = next(index for index in Order.__table__.indexes if index.name == 'ix_orders_Status_OrderDate')
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_orders_Status_OrderDate"))
+        connection.execute(text("CREATE INDEX legacy_orders_status ON orders (status, orderdate)"))
+    assert _has_index(engine, index)
@@ -0,0 +1,65 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from database import get_session
+from migrations import store_money_as_cents
+from models import Drink, from_cents, to_cents
+
+
+@pytest.mark.parametrize("amount, cents", [
+    (Decimal('2.50'), 250),
+    (Decimal('2.345'), 235),
+    (Decimal('-2.345'), -235),
+    (0.1 + 0.2, 30),
+    ("19.99", 1999),
+    (7, 700),
+])
+def test_to_cents_rounds_half_up(amount, cents):
+    assert to_cents(amount) == cents
+
+
+def test_from_cents_round_trip():
+    for cents in (0, 1, 99, 250, 123456):
+        assert from_cents(cents) == Decimal(cents) / 100
+        assert to_cents(from_cents(cents)) == cents
+    assert str(from_cents(250)) == "2.50"
+
+
+@pytest.mark.parametrize("amount", [float('nan'), float('inf'), "-Infinity", Decimal('NaN')])
+def test_non_finite_amounts_are_rejected(amount):
+    with pytest.raises(ValueError):
+        to_cents(amount)
+
+
+def test_money_column_round_trip(db_url):
+    session = get_session(db_url)
+    session.add_all([Drink(name="Water", price=Decimal('2.345')), Drink(name="Juice", price=1.1)])
+    session.commit()
+    session.expire_all()
+    prices = {drink.name: drink.price for drink in session.query(Drink)}
+    assert prices["Water"] == Decimal('2.35')
+    assert prices["Juice"] == Decimal('1.10')
+    cents = session.execute(text("SELECT Price FROM drinks WHERE name = 'Water'")).scalar()
+    assert cents == 235
+    session.remove()
+
+
+def test_store_money_as_cents_keeps_not_null(tmp_path, monkeypatch):
+    # An old drinks table that kept its prices as floats
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE drinks (Id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, Price FLOAT NOT NULL)"))
+        connection.execute(text("INSERT INTO drinks (name, Price) VALUES ('Cola', 2.5), ('Fanta', 2.345)"))
+    monkeypatch.setattr("migrations.MONEY_COLUMNS", [('drinks', 'Price')])
+    store_money_as_cents(engine)
+    price = next(column for column in inspect(engine).get_columns('drinks') if column['name'] == 'Price')
+    assert not price['nullable']
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT Price FROM drinks ORDER BY Id")).scalars().all() == [250, 235]
+    # Already whole cents, a second run changes nothing
+    store_money_as_cents(engine)
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT Price FROM drinks ORDER BY Id")).scalars().all() == [250, 235]
+    engine.dispose()
@@ -0,0 +1,83 @@
+import threading
+from datetime import datetime, timedelta
+
+from change_feed import order_changes
+from order import ORDER_STATUS_MAP, StatusScheduler, get_status_scheduler
+from models import KITCHEN_STAGES
+
+
+def make_scheduler():
+    # Without the thread, the tests pop due transitions themselves
+    scheduler = StatusScheduler(None, ORDER_STATUS_MAP, persist=False)
+    scheduler._ensure_running = lambda: None
+    return scheduler
+
+
+def pop_due(scheduler):
+    with scheduler._condition:
+        return scheduler._pop_due()
+
+
+def test_catches_up_with_the_latest_due_transition():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, datetime.now() - timedelta(minutes=25))
+    assert pop_due(scheduler) == {1: "Prepared"}
+    # The next transition is still tracked
+    assert scheduler._entries.keys() == {1}
+    assert scheduler._heap[0][2] == 2
+
+
+def test_new_order_is_not_due_yet():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, datetime.now())
+    assert pop_due(scheduler) == {}
+    assert scheduler._timeout() > 0
+
+
+def test_discarded_order_is_skipped():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, datetime.now() - timedelta(minutes=25))
+    scheduler.schedule(2, datetime.now() - timedelta(minutes=25))
+    scheduler.discard(1)
+    assert pop_due(scheduler) == {2: "Prepared"}
+
+
+def test_rescheduled_order_only_keeps_its_latest_entry():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, datetime.now() - timedelta(minutes=25))
+    scheduler.schedule(1, datetime.now())
+    assert pop_due(scheduler) == {}
+    assert len(scheduler._heap) == 1
+
+
+def test_last_transition_stops_tracking():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, datetime.now() - timedelta(minutes=45))
+    assert pop_due(scheduler) == {1: "Delivered"}
+    assert scheduler._entries == {}
+    assert scheduler._heap == []
+
+
+def test_schedulers_are_shared_per_database(db_url):
+    scheduler = get_status_scheduler(db_url)
+    assert get_status_scheduler(db_url) is scheduler
+    assert scheduler.persist
+    publishing = get_status_scheduler(db_url, persist_transitions=False)
+    assert publishing is not scheduler
+    assert not publishing.persist
+    assert publishing._transitions == sorted(KITCHEN_STAGES.items())
+
+
+def test_kitchen_stages_are_published(db_url):
+    published = threading.Event()
+
+    def callback(sequence, order_ids):
+        if 42 in order_ids:
+            published.set()
+
+    order_changes.subscribe(callback)
+    try:
+        get_status_scheduler(db_url, persist_transitions=False).schedule(42, datetime.now() - timedelta(minutes=6))
+        assert published.wait(5)
+    finally:
+        order_changes.unsubscribe(callback)
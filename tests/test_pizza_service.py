@@ -0,0 +1,70 @@
+from decimal import Decimal
+
+import pytest
+
+from database import get_session
+from models import Pizza
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+
+
+@pytest.fixture
+def pizza_service(db_url):
+    session = get_session(db_url)
+    return PizzaService(db_url, session=session, order_status_tracker=OrderStatusTracker(db_url, session=session))
+
+
+def menu(pizza_service):
+    pizza_service.session.expire_all()
+    return {pizza.Id: pizza for pizza in pizza_service.session.query(Pizza)}
+
+
+def test_menu_prices_come_from_one_grouped_query(pizza_service):
+    # Ingredient costs plus margin and VAT: pizza 1 has 1 + 2, pizza 2 has 1 + 2 + 3, pizza 3 has 1 + 2 + 3 + 4
+    assert pizza_service.calculate_menu_prices() == {1: Decimal('4.58'), 2: Decimal('9.16'), 3: Decimal('15.26')}
+    assert pizza_service.calculate_menu_prices([2]) == {2: Decimal('9.16')}
+    assert pizza_service.calculate_pizza_price(3) == Decimal('15.26')
+
+
+def test_refresh_writes_the_price_column(pizza_service):
+    pizza_service.refresh_menu_prices()
+    assert {pizza_id: pizza.price for pizza_id, pizza in menu(pizza_service).items()} == \
+        {1: Decimal('4.58'), 2: Decimal('9.16'), 3: Decimal('15.26')}
+    assert [pizza.price for pizza in pizza_service.fetch_pizzas()] == \
+        [Decimal('4.58'), Decimal('9.16'), Decimal('15.26')]
+
+
+def test_ingredient_cost_change_only_reprices_its_pizzas(pizza_service):
+    pizza_service.refresh_menu_prices()
+    # Ingredient 4 is only on pizza 3
+    pizza_service.update_ingredient(4, cost=Decimal('5.00'))
+    prices = {pizza_id: pizza.price for pizza_id, pizza in menu(pizza_service).items()}
+    assert prices == {1: Decimal('4.58'), 2: Decimal('9.16'), 3: Decimal('16.79')}
+
+
+def test_dietary_flags_follow_every_ingredient(pizza_service):
+    # Every ingredient is vegetarian, ingredient 1 (on every pizza) is not vegan
+    assert pizza_service.calculate_dietary_info() == {
+        pizza_id: {'is_vegetarian': True, 'is_vegan': False} for pizza_id in (1, 2, 3)
+    }
+    # A pizza without ingredients has nothing that rules it out
+    assert pizza_service.fetch_dietary_info(99) == {'is_vegetarian': True, 'is_vegan': True}
+
+
+def test_ingredient_flag_change_recomputes_its_pizzas(pizza_service):
+    pizza_service.update_ingredient(1, is_vegan=True)
+    pizzas = menu(pizza_service)
+    # Pizza 1 is ingredients 1 and 2, both vegan now, pizza 2 still has ingredient 3
+    assert (pizzas[1].is_vegetarian, pizzas[1].is_vegan) == (True, True)
+    assert (pizzas[2].is_vegetarian, pizzas[2].is_vegan) == (True, False)
+
+    pizza_service.update_ingredient(2, is_vegetarian=False)
+    pizzas = menu(pizza_service)
+    assert [pizzas[pizza_id].is_vegetarian for pizza_id in (1, 2, 3)] == [False, False, False]
+
+
+def test_set_pizza_ingredients_recomputes_price_and_flags(pizza_service):
+    pizza_service.update_ingredient(1, is_vegan=True)
+    pizza_service.set_pizza_ingredients(3, [2, 4])
+    pizza = menu(pizza_service)[3]
+    assert (pizza.price, pizza.is_vegan) == (Decimal('9.16'), True)
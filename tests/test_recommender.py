@@ -0,0 +1,77 @@
+from database import get_session
+from menu_cache import menu_cache
+from models import Pizza
+from pizza_service import PizzaService
+from recommender.recommender import Recommender
+
+
+def test_similar_pizzas_are_ranked_by_shared_ingredients(db_url):
+    recommender = Recommender(db_url, session=get_session(db_url), top_k=2)
+    # Pizza 1 is ingredients 1-2, pizza 2 is 1-3, pizza 3 is 1-4
+    assert recommender.similar_pizzas(1) == [2, 3]
+    assert recommender.similar_pizzas(3) == [2, 1]
+    assert recommender.similar_pizzas(3, k=1) == [2]
+    assert recommender.similar_pizzas(99) == []
+
+
+def test_index_is_rebuilt_when_the_menu_changes(db_url):
+    session = get_session(db_url)
+    recommender = Recommender(db_url, session=session)
+    assert recommender.similar_pizzas(1) == [2, 3]
+    version = recommender._menu_version
+
+    # The index is only rebuilt on the next read
+    pizza_service = PizzaService(db_url, session=session)
+    pizza_service.add_pizza("Plain", True, True, 5)
+    plain = session.query(Pizza).filter_by(name="Plain").one().Id
+    pizza_service.set_pizza_ingredients(plain, [3, 4])
+    assert recommender._menu_version == version
+    # Pizza 3 shares both ingredients, pizza 2 one of them, pizza 1 none
+    assert recommender.similar_pizzas(plain) == [3, 2]
+    assert recommender._menu_version == menu_cache.version
+    assert plain in recommender.similar_pizzas(3)
+
+
+def place(pizza_service, customer_id, *pizza_ids):
+    return pizza_service.create_order(customer_id, [{'type': 'Pizza', 'id': pizza_id, 'quantity': 1}
+                                                    for pizza_id in pizza_ids])['order_id']
+
+
+def rebuilt(db_url):
+    recommender = Recommender(db_url, session=get_session(db_url))
+    recommender.build_purchase_index()
+    return recommender
+
+
+def test_incremental_cooccurrence_matches_a_rebuild(db_url):
+    session = get_session(db_url)
+    recommender = Recommender(db_url, session=session)
+    recommender.build_purchase_index()
+    pizza_service = PizzaService(db_url, session=session, recommender=recommender)
+    place(pizza_service, 1, 1, 2)
+    place(pizza_service, 1, 2, 3)
+    place(pizza_service, 2, 1)
+    assert (recommender.cooccurrence == rebuilt(db_url).cooccurrence).all()
+    # Bob bought pizza 1, Ann bought 1 together with 2 and 3
+    assert recommender.recommend_for_customer(2) == [2, 3]
+
+
+def test_cancelled_order_is_taken_out_of_the_cooccurrence(db_url):
+    session = get_session(db_url)
+    recommender = Recommender(db_url, session=session)
+    recommender.build_purchase_index()
+    pizza_service = PizzaService(db_url, session=session, recommender=recommender)
+    place(pizza_service, 1, 1, 2)
+    cancelled = place(pizza_service, 1, 2, 3)
+    only = place(pizza_service, 2, 1)
+    assert recommender.recommend_for_customer(2) == [2, 3]
+
+    assert pizza_service.cancel_order(cancelled)
+    assert (recommender.cooccurrence == rebuilt(db_url).cooccurrence).all()
+    assert recommender.recommend_for_customer(2) == [2]
+
+    # Without any order left the customer has no purchases at all
+    assert pizza_service.cancel_order(only)
+    assert (recommender.cooccurrence == rebuilt(db_url).cooccurrence).all()
+    assert recommender.recommend_for_customer(2) == []
+    assert recommender.recommend_for_customer(1) == []
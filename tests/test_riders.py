@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import get_session
+from models import Customer, DeliveryPersonnel, Order
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+from riders import RIDER_COOLDOWN, RiderManagement, RiderPool, address_postal_code
+
+START = datetime(2024, 10, 7, 18, 0)
+
+
+@pytest.mark.parametrize("address", ["6211AB Markt 1", "6211 AB Markt 1", "6211 ab  Markt 1", " 6211ab"])
+def test_address_postal_code_with_and_without_space(address):
+    assert address_postal_code(address) == "6211AB"
+
+
+def test_address_postal_code_falls_back_to_the_first_word():
+    assert address_postal_code("6211 Markt 1") == "6211"
+    assert address_postal_code("") == ""
+    assert address_postal_code(None) == ""
+
+
+def test_pool_hands_out_riders_per_postal_code(db_url):
+    session = get_session(db_url)
+    session.add(DeliveryPersonnel(name="Second", postalCode="6211 ab", available=True))
+    session.commit()
+    pool = RiderPool(session)
+    pool.load()
+    assert pool.available_count("6211AB") == 2
+    assert pool.acquire("6221CD", now=START) is None
+    assert {pool.acquire("6211 AB", now=START), pool.acquire("6211AB", now=START)} == {1, 2}
+    assert pool.acquire("6211AB", now=START) is None
+
+
+def test_rider_comes_back_after_the_cooldown(db_url):
+    session = get_session(db_url)
+    pool = RiderPool(session)
+    pool.load()
+    assert pool.acquire("6211AB", now=START) == 1
+    assert pool.acquire("6211AB", now=START + RIDER_COOLDOWN - timedelta(seconds=1)) is None
+    assert pool.acquire("6211AB", now=START + RIDER_COOLDOWN) == 1
+
+
+def test_release_and_flush_write_availability(db_url):
+    session = get_session(db_url)
+    pool = RiderPool(session)
+    pool.load()
+    pool.acquire("6211AB", now=START)
+    assert pool.flush(now=START) == {1: False}
+    session.commit()
+    assert not session.get(DeliveryPersonnel, 1).available
+
+    assert pool.release(1)
+    assert not pool.release(1)
+    assert pool.flush(now=START) == {1: True}
+    session.commit()
+    session.expire_all()
+    assert session.get(DeliveryPersonnel, 1).available
+    assert pool.flush(now=START) == {}
+
+
+def test_orders_with_a_spaced_postal_code_are_dispatched(db_url):
+    session = get_session(db_url)
+    session.get(Customer, 1).address = "6211 AB Markt 1"
+    session.commit()
+    pizza_service = PizzaService(db_url, session=session, order_status_tracker=OrderStatusTracker(db_url, session=session))
+    order_id = pizza_service.create_order(1, [{'type': 'Pizza', 'id': 1, 'quantity': 1}])['order_id']
+    # Prepared by now
+    session.get(Order, order_id).order_date = datetime.now() - timedelta(minutes=25)
+    session.commit()
+
+    rider_management = RiderManagement(db_url, session=session)
+    assert rider_management.process_orders(dispatch_open=True) == [f"Rider 1 assigned to order {order_id}."]
+    order = session.get(Order, order_id)
+    assert (order.rider_id, order.status) == (1, "Out for Delivery")
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from customer_handling import DEFAULT_DELIVERY_ESTIMATE, CustomerHandling
+from database import get_session
+from models import Customer, Order
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+from riders import BATCH_WINDOW, PREPARED_AFTER, RiderManagement
+from routing import (MINUTES_PER_STOP, POSTAL_CODE_COORDINATES, RESTAURANT_COORDINATES,
+                     RoutePlanner, distance_matrix, nearest_neighbour_route, two_opt)
+
+
+def line_distances(positions):
+    positions = np.asarray(positions, dtype=np.float64)
+    return np.abs(positions[:, None] - positions[None, :])
+
+
+def test_two_opt_removes_crossings():
+    distances = line_distances([0, 1, 2, 3, 4])
+    assert two_opt(np.array([0, 3, 1, 4, 2]), distances).tolist() == [0, 1, 2, 3, 4]
+    # The start stays at the restaurant
+    assert two_opt(np.array([0, 4, 3, 2, 1]), distances).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_nearest_neighbour_route():
+    assert nearest_neighbour_route(line_distances([0, 5, 1, 3])).tolist() == [0, 2, 3, 1]
+
+
+def test_distance_matrix_is_symmetric_in_km():
+    distances = distance_matrix([RESTAURANT_COORDINATES, POSTAL_CODE_COORDINATES["6221"]])
+    assert distances[0, 1] == pytest.approx(distances[1, 0])
+    assert 0.5 < distances[0, 1] < 2.0
+    assert distances[0, 0] == 0
+
+
+@pytest.fixture
+def planner(db_url):
+    return RoutePlanner(db_url, session=get_session(db_url))
+
+
+def test_plan_visits_the_nearest_stop_first(planner):
+    plan = planner.plan([(1, "6224AA"), (2, "6211AB"), (3, "6221CD")])
+    assert [order_id for order_id, _ in plan] == [2, 3, 1]
+    minutes = [eta for _, eta in plan]
+    assert minutes == sorted(minutes)
+    assert minutes[0] >= MINUTES_PER_STOP
+    assert planner.plan([]) == []
+
+
+def test_unknown_postal_code_is_treated_as_the_restaurant(planner, capsys):
+    assert planner.coordinates("9999ZZ") == RESTAURANT_COORDINATES
+    planner.coordinates("9999ZZ")
+    assert capsys.readouterr().out.count("WARNING") == 1
+
+
+def create_order(db_url, customer_id=1):
+    session = get_session(db_url)
+    pizza_service = PizzaService(db_url, session=session, order_status_tracker=OrderStatusTracker(db_url, session=session))
+    return pizza_service.create_order(customer_id, [{'type': 'Pizza', 'id': 1, 'quantity': 1}])['order_id']
+
+
+def test_eta_of_an_order_not_dispatched_yet(db_url, planner):
+    order_id = create_order(db_url)
+    order = planner.session.get(Order, order_id)
+    travel = planner.plan([(order_id, "6211AB")])[0][1]
+    # It leaves when it is prepared and its batch window closed
+    assert planner.estimated_delivery(order_id, now=order.order_date) == \
+        order.order_date + PREPARED_AFTER + BATCH_WINDOW + timedelta(minutes=travel)
+    later = order.order_date + timedelta(hours=1)
+    assert planner.estimated_delivery(order_id, now=later) == later + timedelta(minutes=travel)
+
+
+def test_eta_of_a_dispatched_batch(db_url, planner):
+    session = planner.session
+    session.get(Customer, 2).address = "6211AB Wyck 2"
+    session.commit()
+    order_ids = [create_order(db_url, 1), create_order(db_url, 2)]
+    for order_id in order_ids:
+        session.get(Order, order_id).order_date = datetime.now() - timedelta(minutes=25)
+    session.commit()
+    RiderManagement(db_url, session=session).process_orders(dispatch_open=True)
+
+    order = session.get(Order, order_ids[1])
+    etas = [planner.estimated_delivery(order_id) for order_id in order_ids]
+    # Both stops are in the same area, the second one is one stop later
+    assert etas[1] - etas[0] == timedelta(minutes=MINUTES_PER_STOP)
+    assert etas[0] > order.dispatched_at
+
+
+def test_customer_eta_falls_back_to_the_default(db_url):
+    customer_handling = CustomerHandling(db_url, session=get_session(db_url))
+    order_id = create_order(db_url)
+    minutes = int(customer_handling.calculate_estimated_delivery_time(order_id).split()[0])
+    departure = (PREPARED_AFTER + BATCH_WINDOW).total_seconds() / 60
+    assert departure + MINUTES_PER_STOP - 1 <= minutes <= departure + MINUTES_PER_STOP + 5
+    assert customer_handling.calculate_estimated_delivery_time(999) == DEFAULT_DELIVERY_ESTIMATE
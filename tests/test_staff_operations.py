@@ -0,0 +1,26 @@
+from database import get_session
+from order import OrderStatusTracker
+from pizza_service import PizzaService
+from staff_operations import StaffOp
+
+
+def test_pending_order_changes_follow_the_cursor(db_url):
+    session = get_session(db_url)
+    staff_op = StaffOp(db_url, session=session)
+    pizza_service = PizzaService(db_url, session=session, order_status_tracker=OrderStatusTracker(db_url, session=session))
+    cart = [{'type': 'Pizza', 'id': 1, 'quantity': 1}]
+    first = pizza_service.create_order(1, cart)['order_id']
+
+    # Without a cursor everything pending is returned and the caller replaces its list
+    cursor, orders, removed_ids = staff_op.pending_order_changes()
+    assert [order.Id for order in orders] == [first]
+    assert removed_ids is None
+
+    assert staff_op.pending_order_changes(cursor) == (cursor, [], set())
+
+    second = pizza_service.create_order(2, cart)['order_id']
+    pizza_service.cancel_order(first)
+    cursor, orders, removed_ids = staff_op.pending_order_changes(cursor)
+    assert [order.Id for order in orders] == [second]
+    assert removed_ids == {first}
+    assert [order.Id for order in staff_op.display_pending_orders()] == [second]
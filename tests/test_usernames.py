@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from sqlalchemy import insert, select
+
+from customer_handling import CustomerHandling
+from database import get_engine, get_session
+from migrations import add_username_columns, username_renames
+from models import Customer, normalize_username
+
+
+def test_normalize_username():
+    assert normalize_username(" Bob ") == normalize_username("BOB") == "bob"
+    assert normalize_username(None) == ""
+
+
+def test_names_differing_in_case_cannot_register_twice(db_url):
+    session = get_session(db_url)
+    customer_handling = CustomerHandling(db_url, session=session)
+    assert customer_handling.register_customer("carl", "M", datetime(1980, 2, 2), "6212AA Plein 3", "pw")
+    assert not customer_handling.register_customer(" Carl ", "M", datetime(1980, 2, 2), "6212AA Plein 3", "pw")
+    # The session stays usable for the next call
+    assert customer_handling.login_customer("CARL", "pw")
+    assert session.query(Customer).filter_by(username="carl").count() == 1
+
+
+def test_backfill_renames_clashing_logins_and_records_them(db_url):
+    engine = get_engine(db_url)
+    # Accounts from before the Username column, "Ann " clashes with the existing ann
+    rows = [{"Name": name, "Gender": "F", "Birthdate": datetime(1990, 1, 1), "Address": "6211AB Markt 1",
+             "Password": "x"} for name in ("Ann ", "Dana", "dana")]
+    with engine.begin() as connection:
+        ids = [connection.execute(insert(Customer.__table__).values(**row)).inserted_primary_key[0] for row in rows]
+
+    add_username_columns(engine)
+    with engine.connect() as connection:
+        usernames = dict(connection.execute(select(Customer.Id, Customer.username).where(Customer.Id.in_(ids))).all())
+        renames = connection.execute(select(username_renames.c.UserId, username_renames.c.Username)).all()
+    assert usernames == {ids[0]: f"ann#{ids[0]}", ids[1]: "dana", ids[2]: f"dana#{ids[2]}"}
+    assert sorted(renames) == [(ids[0], f"ann#{ids[0]}"), (ids[2], f"dana#{ids[2]}")]